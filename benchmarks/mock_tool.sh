@@ -0,0 +1,3 @@
+# Stands in for a tool run: writes one output row per parameter row to the sample buffer.
+echo a,b > $MAB_SAMPLE_BUFFER
+awk -F, '{ print $1 "," $2 }' $MAB_PARAM_BUFFER >> $MAB_SAMPLE_BUFFER
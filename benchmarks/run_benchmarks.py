@@ -0,0 +1,171 @@
+#                             MAB-VLSI 
+#
+#                           Copyright 2018 
+#   Regents of the University of California 
+#                         All Rights Reserved
+#
+#                         
+#  MAB-VLSI was developed by Shriram Kumar and Tushar Shah ai at
+#  University of California, San Diego.
+#
+#  If your use of this software contributes to a published paper, we
+#  request that you cite our paper that appears on our website 
+#  http://vlsicad.ucsd.edu/MAB/MAB_v7.pdf
+#
+#  Permission to use, copy, and modify this software and its documentation is
+#  granted only under the following terms and conditions.  Both the
+#  above copyright notice and this permission notice must appear in all copies
+#  of the software, derivative works or modified versions, and any portions
+#  thereof, and both notices must appear in supporting documentation.
+#
+#  This software may be distributed (but not offered for sale or transferred
+#  for compensation) to third parties, provided such third parties agree to
+#  abide by the terms and conditions of this notice.
+#
+#  This software is distributed in the hope that it will be useful to the
+#  community, but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
+
+
+"""
+Benchmarks the hot paths of the reward models and samplers across arm counts and batch sizes.
+
+Results are written as JSON so that they can be kept as a baseline, and a later run can be compared
+against it to catch regressions:
+
+    python benchmarks/run_benchmarks.py --output baseline.json
+    python benchmarks/run_benchmarks.py --compare baseline.json --tolerance 0.25
+"""
+
+import os
+import sys
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import argparse
+import json
+import platform
+import shutil
+import tempfile
+import timeit
+import numpy as np
+import scipy
+from mab.rewards import BinomialRewardModel, ConstrainedRewardModel, GaussianProcessModel, GibbsGaussianProcessModel
+from mab.sampling import GaussianSampler, KdeSampler, ToolSampler, SamplerSet
+from mab.utils import GaussianNoiseModel
+
+ARMS = [3, 10, 100, 1000]
+SAMPLES = [1, 10, 100, 1000, 10000]
+MOCK_TOOL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_tool.sh')
+
+def best_time(function, repeat, min_time = 0.05):
+    """The best time of one call over repeat measurements, each looping until min_time has passed."""
+    timer = timeit.Timer(function)
+    number = 1
+    while timer.timeit(number) < min_time and number < 1e6:
+        number *= 10
+    return min(timer.repeat(repeat, number))/number
+
+def metric(x):
+    return x['a']
+
+def valid(x):
+    return x['a'] > 0
+
+def uncached(batch):
+    """Drops the cached metrics of a batch so that every update evaluates them, as a fresh batch would."""
+    batch._metrics = batch._valid = None
+    return batch
+
+def kernel(arms):
+    x = np.arange(arms)
+    return np.exp(-(x[:, None] - x[None, :])**2/(2*(arms/10. + 1)**2)) + 1e-6*np.eye(arms)
+
+def trained(model, arms):
+    sampler = GaussianSampler(['a'], metric, valid, {}, [0.5], [1], seed = 0)
+    for index in range(arms):
+        model.update(sampler.get_samples(5), index)
+    return model
+
+def reward_models(include_mcmc):
+    models = [('BinomialRewardModel', lambda arms: trained(BinomialRewardModel(arms), arms)),
+              ('ConstrainedRewardModel', lambda arms: trained(ConstrainedRewardModel(arms, np.linspace(1, 2, arms)), arms)),
+              ('GibbsGaussianProcessModel', lambda arms: trained(GibbsGaussianProcessModel(kernel(arms), 1, 5, np.zeros(arms), 5), arms))]
+    if include_mcmc:
+        models.append(('GaussianProcessModel', lambda arms: trained(GaussianProcessModel(kernel(arms), 1, 5, np.zeros(arms), 5), arms)))
+    return models
+
+def samplers(work_dir):
+    history = np.random.RandomState(0).normal(size = (2, 1000))
+    tool = lambda: ToolSampler(['a', 'b'], metric, valid, GaussianNoiseModel([0.01, 0.01]), {'c': 1},
+                               os.path.join(work_dir, 'params.tmp'), os.path.join(work_dir, 'samples.tmp'), MOCK_TOOL, [1, 2])
+    return [('GaussianSampler', lambda: GaussianSampler(['a', 'b'], metric, valid, {'c': 1}, [0, 1], [1, 1])),
+            ('KdeSampler', lambda: KdeSampler(['a', 'b'], metric, valid, {'c': 1}, {'a': history[0], 'b': history[1]})),
+            ('KdeSampler.joint', lambda: KdeSampler(['a', 'b'], metric, valid, {'c': 1}, {'a': history[0], 'b': history[1]}, joint = True)),
+            ('ToolSampler', tool)]
+
+def run(arms_grid, samples_grid, repeat, include_mcmc, limits):
+    results = []
+    def record(name, arms, samples, function):
+        if arms*samples > limits.get(name.split('.')[0], np.inf):
+            return
+        seconds = best_time(function, repeat)
+        results.append({'name': name, 'arms': arms, 'samples': samples, 'seconds': seconds})
+        print '%-50s arms=%-5d samples=%-6d %.6fs' % (name, arms, samples, seconds)
+    for model_name, make_model in reward_models(include_mcmc):
+        for arms in arms_grid:
+            model = make_model(arms)
+            for samples in samples_grid:
+                record(model_name + '.sample_posterior', arms, samples, lambda: model.sample_posterior(samples))
+                record(model_name + '.sample_allocation', arms, samples, lambda: model.sample_allocation(samples))
+                batch = GaussianSampler(['a'], metric, valid, {}, [0.5], [1], seed = 0).get_samples(samples)
+                record(model_name + '.update', arms, samples, lambda: model.update(uncached(batch), arms - 1))
+    work_dir = tempfile.mkdtemp(prefix = 'mab_bench_')
+    try:
+        for sampler_name, make_sampler in samplers(work_dir):
+            for arms in arms_grid:
+                sampler_set = SamplerSet([make_sampler() for i in range(arms)])
+                for samples in samples_grid:
+                    counts = np.bincount(np.arange(samples) % arms, minlength = arms)
+                    record(sampler_name + '.get_samples', arms, samples, lambda: sampler_set.get_samples(counts))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors = True)
+    return results
+
+def compare(results, baseline, tolerance):
+    """Returns the results that are slower than their baseline entry by more than tolerance."""
+    reference = dict(((r['name'], r['arms'], r['samples']), r['seconds']) for r in baseline['results'])
+    regressions = []
+    for r in results:
+        key = (r['name'], r['arms'], r['samples'])
+        if key in reference and r['seconds'] > reference[key]*(1 + tolerance):
+            regressions.append(dict(r, baseline = reference[key]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.split('\n\n')[0])
+    parser.add_argument('--arms', type = int, nargs = '+', default = ARMS, help = 'the arm counts to sweep')
+    parser.add_argument('--samples', type = int, nargs = '+', default = SAMPLES, help = 'the samples per round to sweep')
+    parser.add_argument('--repeat', type = int, default = 3, help = 'the number of measurements to take the best of')
+    parser.add_argument('--include-mcmc', action = 'store_true', help = 'also time the pymc3 GaussianProcessModel, which takes minutes')
+    parser.add_argument('--output', help = 'the JSON file to write the results to')
+    parser.add_argument('--compare', help = 'a baseline JSON file to check the results against')
+    parser.add_argument('--tolerance', type = float, default = 0.25, help = 'the relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    # Caps on arms x samples for the benchmarks whose cost makes the full grid impractical
+    limits = {'GibbsGaussianProcessModel': 1e5, 'GaussianProcessModel': 1e3, 'ConstrainedRewardModel': 1e6, 'ToolSampler': 1e5}
+    results = run(args.arms, args.samples, args.repeat, args.include_mcmc, limits)
+    report = {'python': platform.python_version(), 'numpy': np.__version__, 'scipy': scipy.__version__,
+              'machine': platform.machine(), 'results': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent = 1, sort_keys = True)
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for r in regressions:
+            print 'REGRESSION %-50s arms=%-5d samples=%-6d %.6fs (baseline %.6fs)' % (r['name'], r['arms'], r['samples'], r['seconds'], r['baseline'])
+        sys.exit(1 if regressions else 0)
+
+if __name__ == '__main__':
+    main()
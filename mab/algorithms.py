@@ -27,17 +27,10 @@
 #  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
 
 import numpy as np
-from collections import Counter
-from itertools import chain
-import math
 import logging
-from tqdm import tqdm
-import matplotlib.pyplot as pyplot
-import seaborn as sns
-import pandas as pd
-from scipy.stats import beta
-from utils import Sample
-import pdb
+from utils import Sample, metric_values, valid_mask, NullProfiler
+import json
+import os
 
 class Algorithm(object):
     """
@@ -60,6 +53,7 @@ class Algorithm(object):
         self.reward_models = reward_models
         self.num_arms = len(self.sampler_set)
         self.best_sample = Sample({}, lambda x: -float('Inf'), lambda x: False)
+        self.best_metric = -np.inf
 
     def solve(self, num_rounds, samples_per_round):
         """
@@ -86,13 +80,204 @@ class Algorithm(object):
         """
         raise NotImplementedError('Solve not implemented')
 
+class StoppingRule(object):
+    """
+    Base class for the rules that end :py:func:`algorithms.ThompsonSampling.solve` early once the
+    posterior has converged. A rule is checked after every round.
+
+    ...
+
+    Attributes
+    __________
+    needs_draws: bool
+        Whether the rule uses the full matrix of posterior draws of the round, rather than only
+        the number of times each arm was drawn as the best.
+    """
+    needs_draws = False
+
+    def check(self, solver, allocation, reward_samples):
+        """
+        Returns the reason to stop as a string, or None to keep going.
+        
+        ...
+
+        Parameters
+        __________
+        solver: ThompsonSampling
+            The solver, after the round's samples have been absorbed.
+        allocation: 1d array
+            The number of posterior draws of the round in which each arm had the highest reward.
+        reward_samples: 2d array
+            The posterior draws of the round, or None if no rule of the solver needs them.
+        """
+        raise NotImplementedError('Check not implemented')
+
+class ProbabilityOfBest(StoppingRule):
+    """
+    Stops once the posterior probability that one arm is the best reaches threshold. The probability
+    is estimated from the allocation the round already drew, topped up with sample_allocation to
+    min_draws draws when the round drew fewer: a round of fewer than 1/(1 - threshold) draws cannot
+    tell the threshold apart from certainty.
+
+    ...
+
+    Attributes
+    __________
+    tail_draws: int
+        The number of draws expected outside the best arm at the threshold, in the default min_draws.
+
+    Parameters
+    __________
+    threshold: float
+        The probability of being the best arm at which to stop, below 1.
+    draws: int
+        The minimum number of posterior draws the probability is estimated from, raised to
+        tail_draws/(1 - threshold) if smaller. Topping up is a second posterior sampling, which
+        for the Gaussian process models costs many times a small round.
+    """
+    tail_draws = 2
+
+    def __init__(self, threshold, draws = None):
+        if not 0 < threshold < 1:
+            raise ValueError('The threshold must be between 0 and 1, got ' + str(threshold))
+        self.threshold = threshold
+        self.min_draws = max(draws or 0, int(np.ceil(self.tail_draws/(1. - threshold))))
+
+    def check(self, solver, allocation, reward_samples):
+        if allocation.sum() < self.min_draws:
+            allocation = allocation + solver.reward_models.sample_allocation(self.min_draws - allocation.sum())
+        probability = allocation.max()/float(allocation.sum())
+        if probability >= self.threshold:
+            return 'Arm %d is the best with probability %.3f' % (solver.active_arms[np.argmax(allocation)], probability)
+
+class ExpectedImprovement(StoppingRule):
+    """
+    Stops once the expected improvement of the posterior, see :py:func:`algorithms.ThompsonSampling.expected_improvement`,
+    falls below epsilon. It is estimated from the posterior draws the round already made, topped up
+    with sample_posterior to min_draws draws when the round drew fewer: a single draw always has
+    an expected improvement of zero.
+
+    ...
+
+    Parameters
+    __________
+    epsilon: float
+        The expected improvement below which to stop.
+    draws: int
+        The minimum number of posterior draws the expected improvement is estimated from.
+    """
+    needs_draws = True
+
+    def __init__(self, epsilon, draws = 100):
+        self.epsilon = epsilon
+        self.min_draws = draws
+
+    def check(self, solver, allocation, reward_samples):
+        if len(reward_samples) < self.min_draws:
+            reward_samples = np.concatenate([reward_samples, solver.reward_models.sample_posterior(self.min_draws - len(reward_samples))])
+        improvement = solver.expected_improvement(reward_samples)
+        if improvement < self.epsilon:
+            return 'Expected improvement %.3g is below %.3g' % (improvement, self.epsilon)
+
+class NoImprovement(StoppingRule):
+    """
+    Stops once the best valid metric has not improved for the given number of rounds.
+    """
+    def __init__(self, rounds):
+        self.rounds = rounds
+
+    def check(self, solver, allocation, reward_samples):
+        # The round being checked is not yet counted in rounds_completed
+        history = solver.best_metric_history[:solver.rounds_completed + 1]
+        if len(history) > self.rounds and history[-1] > -np.inf and history[-1] == history[-1 - self.rounds]:
+            return 'Best metric unchanged for %d rounds' % self.rounds
+
+class SuccessiveElimination(object):
+    """
+    Eliminates the arms that are hopeless with near certainty during :py:func:`algorithms.ThompsonSampling.solve`:
+    those whose upper posterior quantile is below the lower posterior quantile of the arm with the best
+    posterior mean.
+
+    A quantile cannot be told apart from the extreme draw with fewer than about 1/quantile draws, so
+    the quantiles are estimated from at least min_draws posterior samples. The draws the round already
+    made are reused, and rounds that drew fewer are topped up with sample_posterior. For the Gaussian
+    process models the top-up costs many times a small round, so use every to eliminate less often.
+    
+    ...
+
+    Attributes
+    __________
+    tail_draws: int
+        The number of draws expected beyond each quantile in the default min_draws.
+
+    Parameters
+    __________
+    quantile: float
+        The tail probability of the lower and upper quantiles.
+    every: int
+        The number of rounds between eliminations.
+    draws: int
+        The minimum number of posterior draws the quantiles are estimated from, raised to
+        tail_draws/quantile if smaller.
+    """
+    needs_draws = True
+    tail_draws = 2
+
+    def __init__(self, quantile = 0.01, every = 1, draws = None):
+        self.quantile = quantile
+        self.every = every
+        self.min_draws = max(draws or 0, int(np.ceil(self.tail_draws/float(quantile))))
+
+    def survivors(self, reward_model, reward_samples):
+        """
+        Returns the indices of the arms of reward_model that survive, in increasing order.
+        
+        ...
+
+        Parameters
+        __________
+        reward_model: RewardModel
+            The model whose arms are considered.
+        reward_samples: 2d array
+            The posterior draws of the round, topped up to min_draws. If None, min_draws are drawn.
+        """
+        if reward_samples is None:
+            reward_samples = np.zeros((0, reward_model.size))
+        if len(reward_samples) < self.min_draws:
+            reward_samples = np.concatenate([reward_samples, reward_model.sample_posterior(self.min_draws - len(reward_samples))])
+        lower, upper = np.percentile(reward_samples, [100*self.quantile, 100*(1 - self.quantile)], axis = 0)
+        best = np.argmax(reward_samples.mean(axis = 0))
+        return np.flatnonzero(upper >= lower[best])
+
 class ThompsonSampling(Algorithm):
+    """
+    Solves the MAB problem by Thompson Sampling, see :py:func:`algorithms.ThompsonSampling.solve`.
+
+    ...
+
+    Attributes
+    __________
+    priority_draws: int
+        The minimum number of posterior samples that the campaign priority is estimated from, in
+        rounds of :py:func:`algorithms.ThompsonSampling.solve` and in the single-sample launches of
+        :py:func:`algorithms.ThompsonSampling.solve_async`.
+    """
+    priority_draws = 32
+
     def __init__(self, sampler_set, reward_models):
         super(ThompsonSampling, self).__init__(sampler_set, reward_models)
-        self.total_count = Counter()
+        self.total_count = np.zeros((self.num_arms,), dtype = int)
+        self.allocation_history = np.zeros((0, self.num_arms), dtype = int)
+        self.best_metric_history = np.zeros((0,))
+        self.rounds_completed = 0
+        self.profiler = NullProfiler()
+        self.campaign = None
+        self.stopping_reason = None
+        self.active_arms = np.arange(self.num_arms)
+        self.cache_report = None
         self.logger = logging.getLogger( 'Thompson Sampling Solver ' + str(id(self)) )
     
-    def solve(self, num_rounds, samples_per_round):
+    def solve(self, num_rounds, samples_per_round, checkpoint_path = None, checkpoint_every = 1, stopping_rules = (), elimination = None):
         """
         Implements :py:func:`algorithms.Algorithm.solve` according to the Thompson Sampling Algorithm [1]_.
         
@@ -100,19 +285,335 @@ class ThompsonSampling(Algorithm):
         __________
 
         .. [1] W.R.Thompson. On the likelihood that one unknown probability exceeds another in view of the evidence of two samples. Biometrika, 25(3-4):285-294, 1933.
+
+        The number of samples allocated to each arm in every round is kept in allocation_history,
+        a rounds x num_arms array, and the best valid metric after every round in best_metric_history.
+        Both cover every round completed by the solver, across calls to solve. The reward model is
+        advanced at the start of every round, see :py:func:`rewards.RewardModel.advance`.
+
+        If the solver is attached to a campaign with :py:func:`algorithms.ThompsonSampling.set_campaign`,
+        the campaign's priority is set every round to the expected improvement of the posterior draws.
+        Rounds of fewer than priority_draws samples draw priority_draws, and allocate from the first
+        samples_per_round of them.
+
+        The hits of the samplers' result caches during the call, and the license-hours they saved,
+        are kept in cache_report.
+
+        ...
+
+        Parameters
+        __________
+        checkpoint_path: string
+            If given, the solver state is saved to this file with :py:func:`algorithms.ThompsonSampling.save_checkpoint`
+            at round boundaries.
+        checkpoint_every: int
+            The number of rounds between checkpoints.
+        stopping_rules: list
+            :py:class:`algorithms.StoppingRule` instances checked after every round. Solving stops after
+            the first round that one of them fires in, with its reason kept in stopping_reason.
+        elimination: SuccessiveElimination
+            If given, the arms it finds hopeless are dropped after the stopping rules of every round. The reward model and
+            sampler set are compacted to the surviving arms, whose original indices are kept in
+            active_arms. The histories and total_count stay indexed by the original arms.
         """
-        for iteration in range(num_rounds):
+        start = self.rounds_completed
+        self.stopping_reason = None
+        cache_snapshots = self.snapshot_caches()
+        needs_draws = self.campaign is not None or any(rule.needs_draws for rule in stopping_rules) or (elimination is not None and elimination.needs_draws)
+        reward_samples = None
+        self.allocation_history = np.concatenate([self.allocation_history[:start], np.zeros((num_rounds, self.num_arms), dtype = int)])
+        self.best_metric_history = np.concatenate([self.best_metric_history[:start], np.full((num_rounds,), -np.inf)])
+        profiler = self.profiler
+        for iteration in range(start, start + num_rounds):
+            profiler.start_round(iteration)
+            self.reward_models.advance()
             # Drawing Samples
-            reward_samples = self.reward_models.sample_posterior(samples_per_round)
-            sample_counts = Counter(np.argmax(reward_samples, axis = 1))
-            self.total_count += sample_counts
-            samples = self.sampler_set.get_samples([sample_counts[i] for i in range(len(self.sampler_set))])
+            with profiler.time('sample_posterior.' + type(self.reward_models).__name__):
+                if not needs_draws:
+                    sample_counts = self.reward_models.sample_allocation(samples_per_round)
+                else:
+                    reward_samples = self.reward_models.sample_posterior(samples_per_round if self.campaign is None else max(samples_per_round, self.priority_draws))
+                    sample_counts = np.bincount(np.argmax(reward_samples[:samples_per_round], axis = 1), minlength = len(self.active_arms))
+            if self.campaign is not None:
+                self.campaign.set_priority(self.expected_improvement(reward_samples))
+            self.allocation_history[iteration, self.active_arms] = sample_counts
+            self.total_count[self.active_arms] += sample_counts
+            with profiler.time('get_samples'):
+                samples = self.sampler_set.get_samples(sample_counts)
             # Updating Reward Models
-            for idx, s in enumerate(samples):
-                self.reward_models.update(s, idx)
+            with profiler.time('update.' + type(self.reward_models).__name__):
+                for idx in np.flatnonzero(sample_counts):
+                    self.reward_models.update(samples[idx], idx)
             # Get the new best sample
-            valid_samples = filter(lambda x: x.is_valid(), reduce(lambda x, y: x+y, samples))
-            self.best_sample = max(valid_samples + [self.best_sample], lambda x: x.get_metric())[0]
+            with profiler.time('best_sample'):
+                for idx in np.flatnonzero(sample_counts):
+                    self.update_best(samples[idx])
+            self.best_metric_history[iteration] = self.best_metric
+            # The rules see the arms the round was drawn over, so they run before any are eliminated
+            with profiler.time('stopping_rules'):
+                for rule in stopping_rules:
+                    self.stopping_reason = rule.check(self, sample_counts, reward_samples)
+                    if self.stopping_reason is not None:
+                        break
+            if elimination is not None and self.stopping_reason is None and (iteration + 1) % elimination.every == 0:
+                with profiler.time('elimination'):
+                    self.eliminate(elimination, reward_samples)
+            profiler.count('posterior_draws', samples_per_round if reward_samples is None else len(reward_samples))
+            profiler.count('samples_per_arm', self.allocation_history[iteration])
+            profiler.end_round()
+            self.rounds_completed += 1
+            if checkpoint_path is not None and ((iteration + 1 - start) % checkpoint_every == 0 or self.stopping_reason is not None):
+                self.save_checkpoint(checkpoint_path)
+            if self.stopping_reason is not None:
+                self.logger.info('Stopping after round ' + str(iteration + 1) + ': ' + self.stopping_reason)
+                break
 
+        self.allocation_history = self.allocation_history[:self.rounds_completed]
+        self.best_metric_history = self.best_metric_history[:self.rounds_completed]
+        self.report_caches(cache_snapshots)
         return self.best_sample if self.best_sample.is_valid() else None
-    
+
+    def solve_async(self, budget, max_in_flight):
+        """
+        Solves the MAB problem one sample at a time as jobs complete, rather than in synchronous rounds.
+
+        If the solver is attached to a campaign, its priority is refreshed every time a job finishes and
+        the freed slot is refilled, see :py:func:`algorithms.ThompsonSampling.draw_launches`.
+
+        Up to max_in_flight single-sample jobs are kept running. Whenever one finishes, the reward
+        model is updated with it and the freed slot is refilled with an arm chosen from a fresh
+        posterior draw, until budget samples have been obtained. The sampler set must support
+        submit and wait_partial, see :py:class:`sampling.AsyncSamplerSet`. Every finished job counts
+        as a round for reward models that forget old observations. Cache hits are reported in
+        cache_report, as for :py:func:`algorithms.ThompsonSampling.solve`.
+        
+        ...
+
+        Parameters
+        __________
+        budget: int
+            The total number of samples to draw.
+        max_in_flight: int
+            The maximum number of jobs running at once.
+
+        Returns
+        _______
+        best_sample: 
+            The best sample obtained i.e. the sample with the highest reward value
+        """
+        if not hasattr(self.sampler_set, 'wait_partial'):
+            raise Exception('Asynchronous solve requires a sampler set that supports submit and wait_partial')
+        cache_snapshots = self.snapshot_caches()
+        launched = min(budget, max_in_flight)
+        for index in self.draw_launches(launched):
+            self.launch(index)
+        completed = 0
+        while completed < budget:
+            # Samples are absorbed as soon as they arrive, even while their job is still running
+            index, samples, done = self.sampler_set.wait_partial()
+            if not done:
+                self.reward_models.update(samples, index)
+                self.update_best(samples)
+                continue
+            completed += 1
+            self.reward_models.advance()
+            if launched < budget:
+                self.launch(self.draw_launches(1)[0])
+                launched += 1
+        self.report_caches(cache_snapshots)
+        return self.best_sample if self.best_sample.is_valid() else None
+
+    def draw_launches(self, count):
+        """
+        Chooses the arms of count jobs of :py:func:`algorithms.ThompsonSampling.solve_async` from a fresh
+        posterior draw. If the solver is attached to a campaign, its priority is refreshed from the same
+        draw, which is then made at least priority_draws samples long so that the expected improvement
+        is not estimated from a single sample.
+        """
+        if self.campaign is None:
+            return np.argmax(self.reward_models.sample_posterior(count), axis = 1)
+        reward_samples = self.reward_models.sample_posterior(max(count, self.priority_draws))
+        self.campaign.set_priority(self.expected_improvement(reward_samples))
+        return np.argmax(reward_samples[:count], axis = 1)
+
+    def set_profiler(self, profiler):
+        """
+        Reports the time spent in every stage of solve, and in every sampler class, to a profiler.
+        
+        ...
+
+        Parameters
+        __________
+        profiler: utils.Profiler
+            The profiler to report to. A :py:class:`utils.NullProfiler` turns profiling off.
+        """
+        self.profiler = profiler
+        self.sampler_set.profiler = profiler
+
+    def snapshot_caches(self):
+        """Returns the distinct result caches of the samplers, each with a snapshot of its counters."""
+        snapshots = []
+        for sampler in self.sampler_set.samplers:
+            cache = getattr(sampler, 'cache', None)
+            if cache is not None and all(cache is not c for c, since in snapshots):
+                snapshots.append((cache, cache.snapshot()))
+        return snapshots
+
+    def report_caches(self, snapshots):
+        """
+        Sets cache_report to the cache hits, misses, hit rate and license-hours saved since the snapshots
+        taken by :py:func:`algorithms.ThompsonSampling.snapshot_caches`, summed over the caches, and logs it.
+        """
+        if not snapshots:
+            self.cache_report = None
+            return
+        reports = [cache.report(since) for cache, since in snapshots]
+        hits, misses = sum(r['hits'] for r in reports), sum(r['misses'] for r in reports)
+        self.cache_report = {'hits': hits,
+                             'misses': misses,
+                             'hit_rate': float(hits)/(hits + misses) if hits + misses else 0.0,
+                             'saved_hours': sum(r['saved_hours'] for r in reports)}
+        self.logger.info('Result cache: ' + json.dumps(self.cache_report))
+
+    def eliminate(self, elimination, reward_samples = None):
+        """
+        Drops the arms that elimination finds hopeless from the reward model and the sampler set.
+        
+        ...
+
+        Parameters
+        __________
+        elimination: SuccessiveElimination
+            The rule that decides which arms survive.
+        reward_samples: 2d array
+            The posterior draws of the current round over the active arms, if any.
+        """
+        keep = elimination.survivors(self.reward_models, reward_samples)
+        if len(keep) == len(self.active_arms):
+            return
+        self.compact(keep)
+        self.logger.info('Eliminated arms, ' + str(len(keep)) + ' remain: ' + str(list(self.active_arms)))
+
+    def compact(self, keep):
+        """Keeps only the active arms at the indices keep in the reward model and the sampler set."""
+        self.reward_models.compact(keep)
+        self.sampler_set.compact(keep)
+        self.active_arms = self.active_arms[keep]
+
+    def set_campaign(self, campaign):
+        """
+        Attaches the solver to a campaign of a shared :py:class:`scheduling.LicenseScheduler`, so that
+        its share of licenses follows the expected improvement its posterior reports. The sampler set
+        should be an :py:class:`sampling.AsyncSamplerSet` that takes its work directories from the campaign.
+        
+        ...
+
+        Parameters
+        __________
+        campaign: scheduling.Campaign
+            The campaign to report to, or None to detach the solver.
+        """
+        self.campaign = campaign
+
+    @staticmethod
+    def expected_improvement(reward_samples):
+        """
+        Returns how much the best arm is expected to improve on the arm that currently looks best,
+        E[max_k r_k] - max_k E[r_k], estimated from a count x num_arms array of posterior draws.
+        It is zero once the posterior has settled on one arm.
+        """
+        return np.mean(np.max(reward_samples, axis = 1)) - np.max(np.mean(reward_samples, axis = 0))
+
+    def save_checkpoint(self, path):
+        """
+        Saves the solver and reward model state to a compressed numpy archive.
+
+        The archive is written to a temporary file that then replaces path, so an interrupted
+        write never leaves a truncated checkpoint behind.
+        
+        ...
+
+        Parameters
+        __________
+        path: string
+            The checkpoint file to write.
+        """
+        state = dict(('reward_' + name, value) for name, value in self.reward_models.get_state().items())
+        state.update(total_count = self.total_count,
+                     active_arms = self.active_arms,
+                     rounds_completed = self.rounds_completed,
+                     allocation_history = self.allocation_history[:self.rounds_completed],
+                     best_metric_history = self.best_metric_history[:self.rounds_completed],
+                     best_metric = self.best_metric,
+                     best_attributes = json.dumps(self.best_sample.attributes, default = lambda x: x.item()))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.savez_compressed(f, **state)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+
+    def load_checkpoint(self, path):
+        """
+        Restores the solver and reward model state saved by :py:func:`algorithms.ThompsonSampling.save_checkpoint`.
+
+        The restored best sample keeps its attributes and reports the metric it was saved with. If arms
+        had been eliminated, the reward model and sampler set, which must cover all arms, are compacted to match.
+        
+        ...
+
+        Parameters
+        __________
+        path: string
+            The checkpoint file to read.
+        """
+        with np.load(path) as state:
+            if 'active_arms' in state.files and len(state['active_arms']) < len(self.active_arms):
+                self.compact(np.searchsorted(self.active_arms, state['active_arms']))
+            self.reward_models.set_state(dict((name[len('reward_'):], state[name]) for name in state.files if name.startswith('reward_')))
+            self.total_count = state['total_count']
+            self.rounds_completed = int(state['rounds_completed'])
+            self.allocation_history = state['allocation_history']
+            self.best_metric_history = state['best_metric_history']
+            self.best_metric = float(state['best_metric'])
+            attributes = json.loads(str(state['best_attributes']))
+        valid = self.best_metric > -np.inf
+        self.best_sample = Sample(attributes, lambda x, metric = self.best_metric: metric, lambda x: valid)
+
+    def resume(self, path, num_rounds, samples_per_round, checkpoint_every = 1, stopping_rules = (), elimination = None):
+        """
+        Restores a campaign from its checkpoint and solves the rounds that remain of it.
+        
+        ...
+
+        Parameters
+        __________
+        path: string
+            The checkpoint file of the campaign. It keeps being updated as the campaign continues.
+        num_rounds: int
+            The total number of rounds of the campaign, including those already completed.
+        samples_per_round: int
+            The number of samples to draw every round.
+        checkpoint_every: int
+            The number of rounds between checkpoints.
+        stopping_rules: list
+            The rules that may end the campaign early, see :py:func:`algorithms.ThompsonSampling.solve`.
+        elimination: SuccessiveElimination
+            The rule that drops hopeless arms, see :py:func:`algorithms.ThompsonSampling.solve`.
+        """
+        self.load_checkpoint(path)
+        return self.solve(max(num_rounds - self.rounds_completed, 0), samples_per_round, path, checkpoint_every, stopping_rules, elimination)
+
+    def launch(self, index):
+        self.total_count[self.active_arms[index]] += 1
+        self.sampler_set.submit(index, 1)
+
+    def update_best(self, samples):
+        metrics = np.where(valid_mask(samples), metric_values(samples), -np.inf)
+        if len(metrics) == 0:
+            return
+        index = np.argmax(metrics)
+        if metrics[index] > self.best_metric:
+            self.best_metric = metrics[index]
+            self.best_sample = samples[index]
+
@@ -0,0 +1,125 @@
+#                             MAB-VLSI 
+#
+#                           Copyright 2018 
+#   Regents of the University of California 
+#                         All Rights Reserved
+#
+#                         
+#  MAB-VLSI was developed by Shriram Kumar and Tushar Shah ai at
+#  University of California, San Diego.
+#
+#  If your use of this software contributes to a published paper, we
+#  request that you cite our paper that appears on our website 
+#  http://vlsicad.ucsd.edu/MAB/MAB_v7.pdf
+#
+#  Permission to use, copy, and modify this software and its documentation is
+#  granted only under the following terms and conditions.  Both the
+#  above copyright notice and this permission notice must appear in all copies
+#  of the software, derivative works or modified versions, and any portions
+#  thereof, and both notices must appear in supporting documentation.
+#
+#  This software may be distributed (but not offered for sale or transferred
+#  for compensation) to third parties, provided such third parties agree to
+#  abide by the terms and conditions of this notice.
+#
+#  This software is distributed in the hope that it will be useful to the
+#  community, but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
+
+
+import numpy as np
+import random
+from multiprocessing import Pool
+
+# The solver factory of the running experiment. Worker processes inherit it when they are
+# forked, so factories do not need to be picklable.
+_make_solver = None
+
+def run_trial(make_solver, seed, num_rounds, samples_per_round):
+    """
+    Runs one seeded trial of a solver.
+
+    Both the numpy and the python random number generators are seeded before the solver is built,
+    so a trial is reproducible from its seed.
+    
+    ...
+
+    Parameters
+    __________
+    make_solver: function
+        A function that takes no arguments and returns a new :py:class:`algorithms.ThompsonSampling`
+        solver, with its own sampler set and reward model.
+    seed: int
+        The seed of the trial.
+    num_rounds: int
+        The number of rounds to solve for.
+    samples_per_round: int
+        The number of samples to draw every round.
+
+    Returns
+    _______
+    (best_metric_history, allocation_history): tuple
+        The best valid metric after every round and the per-round allocation counts of the trial.
+    """
+    np.random.seed(seed)
+    random.seed(seed)
+    solver = make_solver()
+    solver.solve(num_rounds, samples_per_round)
+    return solver.best_metric_history, solver.allocation_history
+
+def _run_forked_trial(args):
+    return run_trial(_make_solver, *args)
+
+def run_trials(make_solver, num_trials, num_rounds, samples_per_round, optimal_metric = None, processes = None, seed = 0):
+    """
+    Runs independent seeded trials of a solver across a process pool and aggregates the results.
+
+    Trial i is seeded with seed + i, so the results do not depend on the number of processes.
+    
+    ...
+
+    Parameters
+    __________
+    make_solver: function
+        A function that takes no arguments and returns a new solver, see :py:func:`evaluation.run_trial`.
+    num_trials: int
+        The number of trials to run.
+    num_rounds: int
+        The number of rounds every trial solves for.
+    samples_per_round: int
+        The number of samples to draw every round.
+    optimal_metric: float
+        The best achievable metric, used to compute regret. Defaults to the best metric reached by any trial.
+    processes: int
+        The number of worker processes. Defaults to the number of cores; 1 runs the trials in this process.
+    seed: int
+        The seed of the first trial.
+
+    Returns
+    _______
+    results: dict
+        'best_metric': num_trials x num_rounds array of the best valid metric after every round.
+        'regret': num_trials x num_rounds array of optimal_metric minus best_metric.
+        'allocations': num_trials x num_rounds x num_arms array of per-round allocation counts.
+        'seeds': the seed of every trial.
+    """
+    global _make_solver
+    jobs = [(seed + i, num_rounds, samples_per_round) for i in range(num_trials)]
+    if processes == 1:
+        results = [run_trial(make_solver, *job) for job in jobs]
+    else:
+        _make_solver = make_solver
+        pool = Pool(processes)
+        try:
+            results = pool.map(_run_forked_trial, jobs, chunksize = 1)
+        finally:
+            pool.close()
+            pool.join()
+            _make_solver = None
+    best_metric = np.array([r[0] for r in results])
+    if optimal_metric is None:
+        optimal_metric = best_metric.max()
+    return {'best_metric': best_metric,
+            'regret': optimal_metric - best_metric,
+            'allocations': np.array([r[1] for r in results]),
+            'seeds': np.array([job[0] for job in jobs])}
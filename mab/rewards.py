@@ -27,12 +27,9 @@
 #  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
 
 import numpy as np
-from scipy.stats import beta, t
-import random
 import uuid
 import os
-from collections import defaultdict
-from scipy.stats import norm
+from utils import metric_values, valid_mask, make_rng, RoundWindow
 
 class RewardModel(object):
     """
@@ -46,9 +43,78 @@ class RewardModel(object):
     size: int
         The dimension of samples that the reward model can digest. This is also the
         dimension of posterior samples it produces.
+    state_attributes: tuple
+        The names of the attributes that hold the learned state of the model. These are
+        saved and restored by get_state and set_state.
+    allocation_block: int
+        The number of posterior samples drawn at a time by sample_allocation.
+    discount: float
+        The factor that the weight of past observations is multiplied by every round, if the model discounts them.
+    history: utils.RoundWindow
+        The observations of the last rounds, if the model only keeps a window of them.
     """
+    state_attributes = ()
+    allocation_block = 1024
+
     def __init__(self, size):
         self.size = size
+        self.discount = None
+        self.history = None
+
+    def keep_recent(self, discount, window, fields, shape):
+        """
+        Makes the model forget old observations, either by discounting their weight every round
+        or by keeping only those of the last window rounds. Used by the models that support it.
+        
+        ...
+        
+        Parameters
+        __________
+        discount: float
+            The factor in (0, 1] that past observations are weighted by every round, or None.
+        window: int
+            The number of rounds of observations to keep, or None.
+        fields: int
+            The number of per-arm statistics the window keeps for every round.
+        shape: tuple
+            The shape of every statistic.
+        """
+        if discount is not None and window is not None:
+            raise Exception('A reward model either discounts or windows its observations, not both')
+        self.discount = discount
+        self.history = None if window is None else RoundWindow(window, fields, shape)
+
+    def advance(self):
+        """
+        Starts a new round. The solver calls it once per round, before sampling the posterior, and
+        models that forget old observations decay them or drop the oldest round of their window here.
+        """
+        pass
+
+    def get_state(self):
+        """Returns the learned state of the model as a dict of numpy arrays."""
+        state = dict((name, np.asarray(getattr(self, name))) for name in self.state_attributes)
+        if self.history is not None:
+            state.update(window_data = self.history.data, window_position = np.asarray(self.history.position))
+        return state
+
+    def set_state(self, state):
+        """
+        Restores the learned state returned by get_state.
+        
+        ...
+        
+        Parameters
+        __________
+        state: dict
+            The mapping from state attribute name -> array.
+        """
+        for name in self.state_attributes:
+            value = np.array(state[name])
+            setattr(self, name, value.item() if value.ndim == 0 else value)
+        if self.history is not None:
+            self.history.data = np.array(state['window_data'])
+            self.history.position = int(state['window_position'])
 
     def update(self, samples, index):
         """
@@ -82,22 +148,270 @@ class RewardModel(object):
         """
         raise NotImplementedError('Sample posterior not implemented')
 
+    def compact(self, keep):
+        """
+        Drops the arms that are not in keep, so that later updates and samples cost only as much as
+        the surviving arms. Arm keep[i] becomes arm i. Implementations should also compact history.
+        
+        ...
+        
+        Parameters
+        __________
+        keep: 1d array
+            The indices of the arms to keep, in increasing order.
+        """
+        raise NotImplementedError('Compact not implemented')
+
+    def sample_allocation(self, count):
+        """
+        Draws count posterior samples and returns how many times each arm had the highest reward,
+        which is all that Thompson Sampling needs of them. The samples are drawn allocation_block
+        at a time, so the full count x size matrix is never held in memory.
+        
+        ...
+        
+        Parameters
+        __________
+        count: int
+            The number of samples to draw from the posterior.
+        """
+        counts = np.zeros((self.size,), dtype = int)
+        for start in range(0, count, self.allocation_block):
+            samples = self.sample_posterior(min(self.allocation_block, count - start))
+            counts += np.bincount(np.argmax(samples, axis = 1), minlength = self.size)
+        return counts
+
 class BinomialRewardModel(RewardModel):
     """
     Implementation of the :py:class:`rewards.RewardModel` interface for Binomial data. Uses 
     Beta distributions to form a model of the success probability at each arm.
+
+    Beta draws are made directly from the model's own random stream, as the ratio of two Gamma
+    draws written into preallocated buffers when it is a numpy.random.Generator, so sampling
+    does not go through scipy.stats.
+
+    ...
+
+    Parameters
+    __________
+    seed: int
+        The seed of the random stream of the model. See :py:func:`utils.make_rng`.
+    discount: float
+        If given, the successes and failures observed so far are weighted by discount at the start
+        of every round, so the posterior decays towards the uniform prior and tracks a changing tool.
+    window: int
+        If given, only the successes and failures of the last window rounds are kept.
     """
-    def __init__(self, size):
+    state_attributes = ('a', 'b')
+
+    def __init__(self, size, seed = None, discount = None, window = None):
         super(BinomialRewardModel, self).__init__(size)
         self.a = np.ones((size,))
         self.b = np.ones((size,))
+        self.rng = make_rng(seed)
+        self.draw_buffer = None
+        self.gamma_buffer = None
+        self.keep_recent(discount, window, 2, self.a.shape)
+
+    def update(self, samples, index):
+        valid = valid_mask(samples)
+        successes, failures = valid.sum(), len(valid) - valid.sum()
+        self.a[index] += successes
+        self.b[index] += failures
+        if self.history is not None:
+            recent = self.history.current()
+            recent[0][index] += successes
+            recent[1][index] += failures
+
+    def advance(self):
+        # The prior pseudo-counts of one success and one failure are never forgotten
+        if self.discount is not None:
+            for counts in (self.a, self.b):
+                counts -= 1
+                counts *= self.discount
+                counts += 1
+        if self.history is not None:
+            dropped = self.history.advance()
+            self.a -= dropped[0]
+            self.b -= dropped[1]
+
+    def buffer(self, name, shape):
+        """Returns a reusable scratch array of the given shape, growing the storage behind it when it is too small."""
+        size = int(np.prod(shape))
+        array = getattr(self, name)
+        if array is None or array.size < size:
+            array = np.empty((size,))
+            setattr(self, name, array)
+        return array[:size].reshape(shape)
+
+    def beta_draws(self, out, a = None, b = None):
+        """
+        Fills out, a count x a.shape array, with draws from the Beta distributions a, b and returns it.
+        The posterior of the model is used if a and b are not given. Only draws from the model's own
+        posterior use its scratch buffer: the campaign views of a stack pass their a and b, and may be
+        sampled from several solver threads at once, so theirs get a temporary array.
+        """
+        if isinstance(self.rng, np.random.RandomState):
+            out[...] = self.rng.beta(self.a if a is None else a, self.b if b is None else b, size = out.shape)
+            return out
+        if a is None and b is None:
+            a, b, other = self.a, self.b, self.buffer('gamma_buffer', out.shape)
+        else:
+            a, b, other = self.a if a is None else a, self.b if b is None else b, np.empty(out.shape)
+        self.rng.standard_gamma(a, size = out.shape, out = out)
+        self.rng.standard_gamma(b, size = out.shape, out = other)
+        other += out
+        out /= other
+        return out
+
+    def sample_posterior(self, count = 1):
+        return self.beta_draws(np.empty((count,) + self.a.shape))
+
+    def compact(self, keep):
+        self.a = self.a[..., keep]
+        self.b = self.b[..., keep]
+        self.size = len(keep)
+        if self.history is not None:
+            self.history.compact(keep)
+
+    def sample_allocation(self, count):
+        counts = np.zeros((self.size,), dtype = int)
+        for start in range(0, count, self.allocation_block):
+            samples = self.beta_draws(self.buffer('draw_buffer', (min(self.allocation_block, count - start), self.size)))
+            counts += np.bincount(np.argmax(samples, axis = 1), minlength = self.size)
+        return counts
+
+class StackedBinomialRewardModel(BinomialRewardModel):
+    """
+    Many independent :py:class:`rewards.BinomialRewardModel` campaigns of size arms each, kept in
+    num_campaigns x size arrays a and b so that all of them are updated and sampled in single
+    vectorized calls.
+
+    update takes a (campaign, arm) pair as its index, and sample_posterior returns a
+    count x num_campaigns x size array. A campaign is used on its own through view, which
+    satisfies the :py:class:`rewards.RewardModel` interface.
+
+    ...
+
+    Parameters
+    __________
+    num_campaigns: int
+        The number of campaigns.
+    size: int
+        The number of arms of every campaign.
+    seed: int
+        The seed of the random stream shared by the campaigns. See :py:func:`utils.make_rng`.
+    """
+    def __init__(self, num_campaigns, size, seed = None, discount = None, window = None):
+        super(StackedBinomialRewardModel, self).__init__(size, seed)
+        self.num_campaigns = num_campaigns
+        self.a = np.ones((num_campaigns, size))
+        self.b = np.ones((num_campaigns, size))
+        self.keep_recent(discount, window, 2, self.a.shape)
+
+    def update_counts(self, campaigns, arms, successes, failures):
+        """
+        Adds observed successes and failures to many (campaign, arm) pairs at once. Pairs may repeat.
+        
+        ...
+
+        Parameters
+        __________
+        campaigns: 1d array
+            The campaign of every observation.
+        arms: 1d array
+            The arm of every observation.
+        successes: 1d array
+            The number of valid samples of every observation.
+        failures: 1d array
+            The number of invalid samples of every observation.
+        """
+        np.add.at(self.a, (campaigns, arms), successes)
+        np.add.at(self.b, (campaigns, arms), failures)
+        if self.history is not None:
+            recent = self.history.current()
+            np.add.at(recent[0], (campaigns, arms), successes)
+            np.add.at(recent[1], (campaigns, arms), failures)
+
+    def sample_allocations(self, counts):
+        """
+        Draws counts[c] posterior samples for every campaign c and returns the num_campaigns x size
+        array of how many times each arm of each campaign had the highest reward.
+        
+        ...
+
+        Parameters
+        __________
+        counts: int or 1d array
+            The number of samples to draw for every campaign.
+        """
+        counts = np.broadcast_to(np.asarray(counts, dtype = int), (self.num_campaigns,))
+        offsets = np.arange(self.num_campaigns)*self.size
+        allocations = np.zeros((self.num_campaigns*self.size,), dtype = int)
+        total = counts.max() if self.num_campaigns else 0
+        block = max(1, self.allocation_block//max(1, self.num_campaigns))
+        for start in range(0, total, block):
+            rows = min(block, total - start)
+            samples = self.beta_draws(self.buffer('draw_buffer', (rows,) + self.a.shape))
+            active = (start + np.arange(rows))[:, None] < counts[None, :]
+            winners = (np.argmax(samples, axis = 2) + offsets)[active]
+            allocations += np.bincount(winners, minlength = len(allocations))
+        return allocations.reshape(self.a.shape)
+
+    def sample_allocation(self, count):
+        """Draws count samples for every campaign, see :py:func:`rewards.StackedBinomialRewardModel.sample_allocations`."""
+        return self.sample_allocations(count)
+
+    def view(self, campaign):
+        """
+        Returns the :py:class:`rewards.RewardModel` of one campaign, sharing the arrays of the stack.
+        Views do not advance the stack, so a discounted or windowed stack has none; advance it directly.
+        """
+        if self.discount is not None or self.history is not None:
+            raise Exception('Campaign views of a discounted or windowed stack are not supported: advance the stack directly')
+        return CampaignRewardModel(self, campaign)
+
+class CampaignRewardModel(RewardModel):
+    """
+    One campaign of a :py:class:`rewards.StackedBinomialRewardModel`, returned by its view method.
+    Updates write through to the stack. The stack must not discount or window its observations.
+
+    The view covers the stack columns listed in arms. Compacting it only narrows that list, so the
+    stack and the other campaigns keep all their arms.
+    """
+    state_attributes = ('a', 'b')
+
+    def __init__(self, stack, campaign):
+        super(CampaignRewardModel, self).__init__(stack.size)
+        self.stack = stack
+        self.campaign = campaign
+        self.arms = np.arange(stack.size)
+
+    @property
+    def a(self):
+        return self.stack.a[self.campaign, self.arms]
+
+    @a.setter
+    def a(self, value):
+        self.stack.a[self.campaign, self.arms] = value
+
+    @property
+    def b(self):
+        return self.stack.b[self.campaign, self.arms]
+
+    @b.setter
+    def b(self, value):
+        self.stack.b[self.campaign, self.arms] = value
 
     def update(self, samples, index):
-        self.a[index] += sum(map(lambda x: x.is_valid(), samples))
-        self.b[index] += sum(map(lambda x: not x.is_valid(), samples))
+        self.stack.update(samples, (self.campaign, self.arms[index]))
 
     def sample_posterior(self, count = 1):
-        return beta.rvs(self.a, self.b, size = (count, self.size))
+        return self.stack.beta_draws(np.empty((count, self.size)), self.a, self.b)
+
+    def compact(self, keep):
+        self.arms = self.arms[keep]
+        self.size = len(keep)
 
 class ConstrainedRewardModel(BinomialRewardModel):
     """
@@ -107,27 +421,71 @@ class ConstrainedRewardModel(BinomialRewardModel):
     These contraints arise naturally in some settings such as increasing clock periods 
     in VLSI designs. When applicable, the constraints can help reduce sample complexity 
     dramatically and should be used.
+
+    ...
+
+    Parameters
+    __________
+    reward_values: list
+        The reward of a valid sample at every arm.
+    max_iter: int
+        The number of Gibbs sweeps per posterior sample.
+    seed: int
+        The seed of the random stream of the model. See :py:func:`utils.make_rng`.
+    discount: float
+        If given, old observations are discounted every round, see :py:class:`rewards.BinomialRewardModel`.
+    window: int
+        If given, only the observations of the last window rounds are kept.
     """
-    def __init__(self, size, reward_values, max_iter = 5):
-        super(ConstrainedRewardModel, self).__init__(size)
+    def __init__(self, size, reward_values, max_iter = 5, seed = None, discount = None, window = None):
+        super(ConstrainedRewardModel, self).__init__(size, seed, discount, window)
         self.max_iter = max_iter
         self.reward_values = reward_values
 
+    def get_truncated_samples(self, count = 1):
+        """
+        Draws count posterior samples using Gibbs sweeps of inverse-CDF sampling from truncated Betas.
+
+        All count chains are advanced together, so every sweep costs one vectorized cdf/ppf call per arm.
+        
+        ...
+
+        Parameters
+        __________
+        count: int
+            The number of independent chains, and therefore samples, to draw.
+        """
+        from scipy.stats import beta
+        samples = np.full((count, self.size), np.nan)
+        no_upper = np.full((count,), np.inf)
+        no_lower = np.zeros((count,))
+        for sweep in range(self.max_iter):
+            for index, (a, b) in enumerate(zip(self.a, self.b)):
+                u = no_upper if index == 0 else samples[:, index - 1]
+                l = no_lower if index == self.size - 1 else np.nan_to_num(samples[:, index + 1])
+                samples[:, index] = beta.ppf(self.rng.uniform(beta.cdf(l, a, b), beta.cdf(u, a, b)), a, b)
+        return samples*np.asarray(self.reward_values)
+
     def get_truncated_sample(self):
-        # Inverse sampling
-        get_with_default = lambda x, y: y if np.isnan(x) else x 
-        inv_sample = lambda a, b, l, u: beta.ppf(random.uniform(beta.cdf(l, a, b), beta.cdf(u, a, b)), a, b)
-        sample = [np.nan]*self.size
-        l, u = 0, np.inf
-        for idx, (a, b) in enumerate(zip(self.a, self.b)*self.max_iter):
-            index = idx%self.size
-            u = np.inf if index == 0 else sample[index- 1] ### Check logic here
-            l = 0 if index == self.size - 1 else get_with_default(sample[index + 1], 0)
-            sample[index] = inv_sample(a, b, l, u)
-        return [s*r for s, r in zip(sample, self.reward_values)]
+        return self.get_truncated_samples(1)[0].tolist()
 
     def sample_posterior(self, count = 1):
-        return np.array([self.get_truncated_sample() for i in range(count)])
+        return self.get_truncated_samples(count)
+
+    def sample_allocation(self, count):
+        return RewardModel.sample_allocation(self, count)
+
+    def compact(self, keep):
+        super(ConstrainedRewardModel, self).compact(keep)
+        self.reward_values = np.asarray(self.reward_values)[keep]
+
+def merge_statistics(counts, means, squares, index, metrics):
+    """Folds metrics into the count, mean and sum of squared deviations held at index of the three arrays."""
+    count, mean = counts[index] + len(metrics), metrics.mean()
+    delta = mean - means[index]
+    squares[index] += ((metrics - mean)**2).sum() + delta**2*counts[index]*len(metrics)/count
+    means[index] += delta*len(metrics)/count
+    counts[index] = count
 
 class GaussianProcessModel(RewardModel):
     """
@@ -144,17 +502,20 @@ class GaussianProcessModel(RewardModel):
         A 2d kernel matrix. This controls the amount of smoothness that the model assumes apriori.
     m0: 1d array
         The prior reward means that the model assumes.
+    discount: float
+        If given, the weight of the observations made so far is multiplied by discount at the start
+        of every round, so the model tracks a tool whose results drift.
+    window: int
+        If given, only the observations of the last window rounds are kept.
     For more details about other parameters, see `this gaussian process tutorial <http://www.gaussianprocess.org/#tut/>`_.
     
     """    
     mean_name = "mu"
     std_name = "sigma"
+    state_attributes = ('counts', 'means', 'squares', 'current_maxima')
 
-    def __init__(self, K0, a, b, m0, prec0, sample_burn = 100, sample_thin = 3, sample_tune = 1500):
+    def __init__(self, K0, a, b, m0, prec0, sample_burn = 100, sample_thin = 3, sample_tune = 1500, discount = None, window = None):
         super(GaussianProcessModel, self).__init__(len(m0))
-        os.environ["THEANO_FLAGS"] = "base_compiledir=~/.theano/" + str(uuid.uuid4())
-        import pymc3 as pm
-        self.pm = pm
 		
         # Setting prior parameters
         self.kernel = prec0*K0
@@ -167,25 +528,155 @@ class GaussianProcessModel(RewardModel):
         self.sample_thin = sample_thin
         self.sample_tune = sample_tune
 		
-        self.posterior_model = pm.Model()
-        self.data = defaultdict(list)
+        # Per-arm sufficient statistics of the observed metrics
+        self.counts = np.zeros((self.size,))
+        self.means = np.zeros((self.size,))
+        self.squares = np.zeros((self.size,))
         self.current_maxima = -np.inf
+        # Per round and arm: count, mean, sum of squared deviations, and the count and maximum of the valid metrics
+        self.keep_recent(discount, window, 5, (self.size,))
+        self.setup_backend()
+
+    def setup_backend(self):
+        os.environ["THEANO_FLAGS"] = "base_compiledir=~/.theano/" + str(uuid.uuid4())
+        import pymc3 as pm
+        self.pm = pm
+        self.posterior_model = pm.Model()
 
     def update(self, data, index):
-        '''Updates are performed lazily. Data is just stored into a local buffer when update is called'''
-        self.data[index] += data
-        self.current_maxima = max(self.current_maxima, *map(lambda x: x.get_metric(), filter(lambda x: x.is_valid(), data)))
+        '''Folds the metrics of the samples into the running count, mean and sum of squared deviations of the arm.'''
+        metrics = metric_values(data)
+        if len(metrics) == 0:
+            return
+        valid = valid_mask(data)
+        merge_statistics(self.counts, self.means, self.squares, index, metrics)
+        if self.history is not None:
+            counts, means, squares, valid_counts, maxima = self.history.current()
+            merge_statistics(counts, means, squares, index, metrics)
+            if valid.any():
+                maxima[index] = max(maxima[index], metrics[valid].max()) if valid_counts[index] else metrics[valid].max()
+                valid_counts[index] += valid.sum()
+        if valid.any():
+            self.current_maxima = max(self.current_maxima, metrics[valid].max())
+
+    def advance(self):
+        """
+        Forgets old observations. current_maxima, the level the posterior reward is measured against,
+        forgets them too: a windowed model takes the best valid metric within the window, and a
+        discounted model moves it towards the best arm mean by the discount factor every round, so
+        a maximum seen before the tool drifted does not stay the reference forever.
+        """
+        if self.discount is not None:
+            self.counts *= self.discount
+            self.squares *= self.discount
+            observed = self.counts > 0
+            if observed.any() and self.current_maxima > -np.inf:
+                best_mean = self.means[observed].max()
+                self.current_maxima = best_mean + self.discount*(self.current_maxima - best_mean)
+        if self.history is not None:
+            # The statistics of the window are pooled from those of its rounds
+            self.history.advance()
+            counts, means, squares, valid_counts, maxima = self.history.data.transpose(1, 0, 2)
+            self.counts = counts.sum(axis = 0)
+            self.means = np.divide((counts*means).sum(axis = 0), self.counts, out = np.zeros((self.size,)), where = self.counts > 0)
+            self.squares = (squares + counts*(means - self.means)**2).sum(axis = 0)
+            self.current_maxima = maxima[valid_counts > 0].max() if (valid_counts > 0).any() else -np.inf
+
+    def compact(self, keep):
+        self.kernel = self.kernel[np.ix_(keep, keep)]
+        self.m0 = np.asarray(self.m0)[keep]
+        if np.ndim(self.a):
+            self.a = np.asarray(self.a)[keep]
+        if np.ndim(self.b):
+            self.b = np.asarray(self.b)[keep]
+        self.counts, self.means, self.squares = self.counts[keep], self.means[keep], self.squares[keep]
+        self.size = len(keep)
+        if self.history is not None:
+            self.history.compact(keep)
+
+    def residual_squares(self, mu):
+        """The sum of squared residuals of every arm's observations around the arm means mu."""
+        return self.squares + self.counts*(self.means - mu)**2
 
     def push_updates(self):
-		with self.pm.Model() as model:
-			sigma = self.pm.Gamma(self.std_name, alpha = self.a, beta = self.b, shape=self.size)
-			mu = self.pm.MvNormal(self.mean_name, mu = self.m0, cov = self.kernel, shape=self.size)
-			x_ = [self.pm.Normal('x' + str(i), mu[i], sigma[i], observed = map(lambda x: x.get_metric(), self.data[i])) for i in range(self.size)]
-			self.posterior_model = model
+        with self.pm.Model() as model:
+            sigma = self.pm.Gamma(self.std_name, alpha = self.a, beta = self.b, shape=self.size)
+            mu = self.pm.MvNormal(self.mean_name, mu = self.m0, cov = self.kernel, shape=self.size)
+            # Normal log likelihood of the observations, written in terms of the sufficient statistics
+            self.pm.Potential('x', self.pm.math.sum(-self.counts*self.pm.math.log(sigma) - self.residual_squares(mu)/(2*sigma**2)))
+            self.posterior_model = model
     
     def sample_posterior(self, count = 1):
         self.push_updates()
         with self.posterior_model:
             trace_ = self.pm.sample(self.sample_thin*count + self.sample_burn, njobs=1, progressbar=False, tune=self.sample_tune)
         samples = trace_[self.sample_burn::self.sample_thin]
+        from scipy.stats import norm
         return norm.sf(self.current_maxima, loc = samples[self.mean_name], scale = samples[self.std_name])
+
+def precision_prior(a, b):
+    """
+    Returns the shape and rate of the Gamma prior on the noise precision 1/sigma**2 that matches a
+    Gamma(a, b) prior on the noise standard deviation sigma, as used by :py:class:`rewards.GaussianProcessModel`.
+
+    The two are matched in the mean and variance of the log precision, which are finite for every a and b:
+    if sigma ~ Gamma(a, b) then log(1/sigma**2) has mean -2*(digamma(a) - log(b)) and variance 4*trigamma(a),
+    and a Gamma(shape, rate) precision has digamma(shape) - log(rate) and trigamma(shape).
+    """
+    from scipy.special import digamma, polygamma
+    from scipy.optimize import brentq
+    a, b = np.asarray(a, dtype = float), np.asarray(b, dtype = float)
+    shape = np.vectorize(lambda a: brentq(lambda x: polygamma(1, x) - 4*polygamma(1, a), 1e-8, 1e8))(a)
+    rate = np.exp(digamma(shape) + 2*(digamma(a) - np.log(b)))
+    return shape, rate
+
+class GibbsGaussianProcessModel(GaussianProcessModel):
+    """
+    A :py:class:`rewards.GaussianProcessModel` whose posterior is sampled with a closed-form Gibbs sampler
+    instead of pymc3.
+
+    The Gamma(a, b) prior that :py:class:`rewards.GaussianProcessModel` puts on the noise standard deviation
+    is converted, with :py:func:`rewards.precision_prior`, into the closest Gamma(tau_a, tau_b) prior on the
+    noise precision, which makes both conditionals conjugate: the arm means are drawn from a multivariate
+    normal and the noise precisions from Gammas. The two engines therefore take the same arguments and
+    agree once the data dominate the prior. The prior kernel is factorized once, and the chain is warm
+    started from its last state on every call, so a round costs milliseconds and does not need pymc3 or Theano.
+    """
+    state_attributes = GaussianProcessModel.state_attributes + ('mu', 'tau')
+
+    def setup_backend(self):
+        import scipy.linalg
+        from scipy.special import ndtr
+        self.linalg = scipy.linalg
+        self.ndtr = ndtr
+        prior_factor = self.linalg.cho_factor(self.kernel, lower = True)
+        self.prior_precision = self.linalg.cho_solve(prior_factor, np.eye(self.size))
+        self.prior_shift = self.linalg.cho_solve(prior_factor, np.asarray(self.m0, dtype = float))
+        self.tau_a, self.tau_b = precision_prior(self.a, self.b)
+        self.mu = np.array(self.m0, dtype = float)
+        self.tau = np.ones((self.size,))*self.tau_a/self.tau_b
+
+    def compact(self, keep):
+        # The prior factorization is redone for the surviving arms, and the chain continues from its state
+        mu, tau = self.mu[keep], self.tau[keep]
+        super(GibbsGaussianProcessModel, self).compact(keep)
+        self.setup_backend()
+        self.mu, self.tau = mu, tau
+
+    def gibbs_sweep(self):
+        """Advances the chain by drawing the arm means and then the noise precisions from their conditionals."""
+        factor = np.linalg.cholesky(self.prior_precision + np.diag(self.counts*self.tau))
+        mean = self.linalg.cho_solve((factor, True), self.prior_shift + self.tau*self.counts*self.means)
+        self.mu = mean + self.linalg.solve_triangular(factor, np.random.standard_normal(self.size), lower = True, trans = 'T')
+        self.tau = np.random.gamma(self.tau_a + self.counts/2, 1./(self.tau_b + self.residual_squares(self.mu)/2))
+
+    def sample_posterior(self, count = 1):
+        mu, sigma = np.empty((count, self.size)), np.empty((count, self.size))
+        for i in range(self.sample_burn):
+            self.gibbs_sweep()
+        for i in range(count):
+            for j in range(self.sample_thin):
+                self.gibbs_sweep()
+            mu[i], sigma[i] = self.mu, 1/np.sqrt(self.tau)
+        # The normal survival function, norm.sf(current_maxima, mu, sigma), without the scipy.stats import
+        return self.ndtr((mu - self.current_maxima)/sigma)
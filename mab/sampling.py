@@ -27,11 +27,21 @@
 #  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
 
 import uuid
-from utils import Sample
+from utils import Sample, SampleBatch, concatenate_samples, make_rng, NormalPool, NullProfiler
 import logging
 import numpy as np
-from scipy.stats import gaussian_kde
 import subprocess
+import os
+import shutil
+import tempfile
+import Queue
+import io
+import hashlib
+import json
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+from collections import OrderedDict
 
 class Sampler(object):
     """
@@ -51,12 +61,25 @@ class Sampler(object):
         calculates the boolean validity of the sample.
     constants: dict
         The set of constants that are part of every sample.
+    batch_metric_function: function
+        Optional function that takes a dict of attribute columns, with the constants as scalars, and
+        returns the array of metric values of the whole batch. Used instead of metric_function for
+        batches when given.
+    batch_valid_function: function
+        Optional function that takes a dict of attribute columns and returns the boolean array of
+        validity of the whole batch. Used instead of valid_function for batches when given.
+    needs_work_dir: bool
+        Whether the sampler runs external jobs that need a scratch directory of their own.
     """
-    def __init__(self, attribute_names, metric_function, valid_function, constants):
+    needs_work_dir = False
+
+    def __init__(self, attribute_names, metric_function, valid_function, constants, batch_metric_function = None, batch_valid_function = None):
         self.attribute_names = attribute_names
         self.metric_function = metric_function
         self.valid_function = valid_function
         self.constants = constants
+        self.batch_metric_function = batch_metric_function
+        self.batch_valid_function = batch_valid_function
 
     def make_sample(self, attribute_values):
         """
@@ -73,10 +96,30 @@ class Sampler(object):
         attributes.update(self.constants)
         return Sample(attributes, self.metric_function, self.valid_function)
 
+    def make_batch(self, values, names = None):
+        """
+        Generates a new batch of samples.
+        
+        ...
+        
+        Parameters
+        __________
+        values: 2d array
+            The values to generate the batch from, one row per sample.
+        names: list
+            The attribute names of the columns of values. Defaults to attribute_names.
+        """
+        names = list(self.attribute_names if names is None else names)
+        values = np.asarray(values, dtype = float).reshape(len(values), -1 if len(values) else len(names))
+        names = names[:values.shape[1]]
+        columns = dict(zip(names, values.T.copy()))
+        return SampleBatch(names, columns, self.constants, self.metric_function, self.valid_function, len(values),
+                           self.batch_metric_function, self.batch_valid_function)
+
     def get_samples(self, count):
         raise NotImplementedError('Get samples not implemented')
 
-class SamplerSet:
+class SamplerSet(object):
     """
     Class to wrap a set of samplers and allow sampling the set for given batch sizes.
 
@@ -86,9 +129,12 @@ class SamplerSet:
     __________
     samplers: list
         The set of samplers to generate the SamplerSet from.
+    profiler: utils.Profiler
+        The profiler that the time spent in every sampler class is reported to.
     """
     def __init__(self, samplers):
         self.samplers = samplers
+        self.profiler = NullProfiler()
 
     def get_samples(self, sample_counts):
         """
@@ -101,11 +147,217 @@ class SamplerSet:
         sample_counts: int
             The number of samples to obtain.
         """
-        return [s.get_samples(c) for s, c in zip(self.samplers, sample_counts)]
+        samples = []
+        for s, c in zip(self.samplers, sample_counts):
+            with self.profiler.time('get_samples.' + type(s).__name__):
+                samples.append(s.get_samples(c))
+        return samples
+
+    def compact(self, keep):
+        """Keeps only the samplers at the indices keep, in order. Used when arms are eliminated."""
+        self.samplers = [self.samplers[i] for i in keep]
 
     def __len__(self):
         return len(self.samplers)
 
+class WorkDirPool(object):
+    """
+    A bounded pool of scratch directories, one per concurrently running tool job.
+
+    The size of the pool is the maximum number of jobs that may run at once, and should
+    be set to the license or CPU limit.
+    
+    ...
+    
+    Parameters
+    __________
+    size: int
+        The number of scratch directories in the pool.
+    root: string
+        The directory to create the scratch directories in. A temporary directory is used
+        if none is given.
+    """
+    def __init__(self, size, root = None):
+        self.owns_root = root is None
+        self.root = tempfile.mkdtemp(prefix = 'mab_') if root is None else root
+        self.directories = Queue.Queue()
+        for i in range(size):
+            directory = os.path.join(self.root, 'job' + str(i))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.directories.put(directory)
+        self.size = size
+
+    def acquire(self):
+        """Block until a scratch directory is free and return its path."""
+        return self.directories.get()
+
+    def release(self, directory):
+        """Return a scratch directory obtained from acquire to the pool."""
+        self.directories.put(directory)
+
+    def cleanup(self):
+        """Remove the scratch directories if the pool created them."""
+        if self.owns_root:
+            shutil.rmtree(self.root, ignore_errors = True)
+
+    def __len__(self):
+        return self.size
+
+class AsyncSamplerSet(SamplerSet):
+    """
+    A :py:class:`sampling.SamplerSet` that runs the jobs of all arms concurrently.
+
+    Samplers that need a work directory (see :py:class:`sampling.ToolSampler`) are given an
+    isolated scratch directory from the pool for the duration of each job, so at most
+    len(work_dir_pool) tool runs are active at once. Jobs can also be submitted one at a time
+    and collected as they finish.
+
+    ...
+    
+    Attributes
+    __________
+    samplers: list
+        The set of samplers to generate the SamplerSet from.
+    work_dir_pool: WorkDirPool
+        The pool of scratch directories that bounds the number of concurrent jobs.
+    """
+    def __init__(self, samplers, work_dir_pool, stream = False):
+        super(AsyncSamplerSet, self).__init__(samplers)
+        self.work_dir_pool = work_dir_pool
+        self.stream = stream
+        self.workers = ThreadPool(len(work_dir_pool))
+        self.finished = Queue.Queue()
+        self.partial = {}
+        self.pending = 0
+        self.next_job = 0
+
+    def job_batches(self, index, count):
+        """
+        Draw count samples from one sampler in the calling thread, yielding them in one piece, or
+        as the sampler produces them if stream is set and the sampler supports iter_samples.
+        
+        ...
+        
+        Parameters
+        __________
+        index: int
+            The index of the sampler to draw from.
+        count: int
+            The number of samples to draw.
+        """
+        sampler = self.samplers[index]
+        if self.stream and hasattr(sampler, 'iter_samples'):
+            draw = lambda *args: sampler.iter_samples(*args, stream = True)
+        else:
+            draw = lambda *args: [sampler.get_samples(*args)]
+        if not sampler.needs_work_dir:
+            for samples in draw(count):
+                yield samples
+            return
+        work_dir = self.work_dir_pool.acquire()
+        try:
+            for samples in draw(count, work_dir):
+                yield samples
+        finally:
+            self.work_dir_pool.release(work_dir)
+
+    def run_job(self, index, count):
+        """
+        Draw count samples from one sampler in the calling thread.
+        
+        ...
+        
+        Parameters
+        __________
+        index: int
+            The index of the sampler to draw from.
+        count: int
+            The number of samples to draw.
+        """
+        pieces = list(self.job_batches(index, count))
+        return concatenate_samples(pieces) if pieces else []
+
+    def _finish_job(self, job, index, count):
+        try:
+            for samples in self.job_batches(index, count):
+                self.finished.put((job, index, samples, None, False))
+            self.finished.put((job, index, None, None, True))
+        except Exception as err:
+            self.finished.put((job, index, None, err, True))
+
+    def submit(self, index, count):
+        """
+        Start drawing count samples from a sampler without waiting for them. The result
+        is obtained from :py:func:`sampling.AsyncSamplerSet.wait` or, piece by piece, from
+        :py:func:`sampling.AsyncSamplerSet.wait_partial`. Only one of the two should be used.
+        
+        ...
+        
+        Parameters
+        __________
+        index: int
+            The index of the sampler to draw from.
+        count: int
+            The number of samples to draw.
+        """
+        job = self.next_job
+        self.next_job += 1
+        self.pending += 1
+        self.workers.apply_async(self._finish_job, (job, index, count))
+        return job
+
+    def wait_partial(self):
+        """
+        Block until a submitted job produces samples or finishes.
+
+        Returns
+        _______
+        (index, samples, done): tuple
+            The index of the sampler, the samples produced, which are None when done, and whether
+            the job has finished.
+        """
+        job, index, samples, err, done = self.finished.get()
+        if done:
+            self.pending -= 1
+        if err is not None:
+            raise err
+        return index, samples, done
+
+    def wait(self):
+        """
+        Block until the next submitted job finishes.
+
+        Returns
+        _______
+        (index, samples): tuple
+            The index of the sampler that finished and the samples it produced.
+        """
+        while True:
+            job, index, samples, err, done = self.finished.get()
+            if not done:
+                self.partial.setdefault(job, []).append(samples)
+                continue
+            self.pending -= 1
+            pieces = self.partial.pop(job, [])
+            if err is not None:
+                raise err
+            return index, concatenate_samples(pieces) if pieces else []
+
+    def get_samples(self, sample_counts):
+        jobs = [(index, count) for index, count in enumerate(sample_counts) if count > 0]
+        for index, count in jobs:
+            self.submit(index, count)
+        samples = [[] for s in self.samplers]
+        for job in jobs:
+            index, samples[index] = self.wait()
+        return samples
+
+    def close(self):
+        """Stop the worker threads once the pending jobs are done."""
+        self.workers.close()
+        self.workers.join()
+
 class GaussianSampler(Sampler): 
     """
     Implementation of the Sampler interface using a normal distribution to generate the samples.
@@ -118,18 +370,26 @@ class GaussianSampler(Sampler):
         The mean value to use per attribute. The order of attributes is the same as in attribute_names.
     attribute_stds: list
         The standard deviation to use per attribute. The order of attributes is the same as in attribute_names.
+    seed: int
+        The seed of the random stream of the sampler, see :py:func:`utils.make_rng`.
+    block_size: int
+        If given, normals are drawn from a :py:class:`utils.NormalPool` of this block size, which makes many
+        small draws cheaper.
     """ 
-    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_means, attribute_stds):
-        super(GaussianSampler, self).__init__(attribute_names, metric_function, valid_function, constants)
+    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_means, attribute_stds, batch_metric_function = None, batch_valid_function = None, seed = None, block_size = None):
+        super(GaussianSampler, self).__init__(attribute_names, metric_function, valid_function, constants, batch_metric_function, batch_valid_function)
         self.attribute_means = attribute_means
         self.attribute_stds = attribute_stds
+        self.means = np.asarray(attribute_means, dtype = float)
+        self.scale = np.asarray(attribute_stds, dtype = float)
+        self.rng = make_rng(seed)
+        self.normals = NormalPool(self.rng, block_size) if block_size else None
         self.logger = logging.getLogger('Gaussian Sampler ' + str(id(self)))
 
     def get_samples(self, count):
-        if count == 0:
-            return []
-        samples = np.random.multivariate_normal(self.attribute_means, np.diag(self.attribute_stds)**2, int(count))
-        return map(self.make_sample, samples)
+        shape = (int(count), len(self.means))
+        normals = self.rng.standard_normal(shape) if self.normals is None else self.normals.draw(shape)
+        return self.make_batch(self.means + normals*self.scale)
 
 class KdeSampler(Sampler):
     """
@@ -142,23 +402,331 @@ class KdeSampler(Sampler):
     attribute_data: dict
         Dict containing the mapping from attribute name -> list of data. This data is used in the KDE model
         to generate new samples.
+    joint: bool
+        Whether to fit one multivariate KDE over all attributes, which keeps the correlation between them,
+        instead of one KDE per attribute. The lists in attribute_data must then be aligned run by run.
+    max_history: int
+        If given, the KDE is fitted on a random subset of at most max_history runs.
     """
-    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_data):
+    def __init__(self, attribute_names, metric_function, valid_function, constants, attribute_data, batch_metric_function = None, batch_valid_function = None, joint = False, max_history = None):
         ''''''
-        super(KdeSampler, self).__init__(attribute_names, metric_function, valid_function, constants)
-        self.kde_estimates = dict([(name, gaussian_kde(data)) for name, data in attribute_data.items() if name not in constants])
+        super(KdeSampler, self).__init__(attribute_names, metric_function, valid_function, constants, batch_metric_function, batch_valid_function)
+        from scipy.stats import gaussian_kde
         self.constants = constants
+        self.joint = joint
+        self.names = [name for name in self.attribute_names if name not in constants]
+        if joint:
+            data = np.array([attribute_data[name] for name in self.names], dtype = float)
+            self.joint_data = self.subsample(data.T, max_history)
+            # A draw from the KDE is a random data point plus normal noise with the kernel covariance
+            self.joint_factor = self.factorize(gaussian_kde(self.joint_data.T).covariance)
+        else:
+            self.kde_estimates = dict([(name, gaussian_kde(self.subsample(np.asarray(data, dtype = float), max_history)))
+                                       for name, data in attribute_data.items() if name not in constants])
         self.logger = logging.getLogger('Gaussian Sampler ' + str(id(self)))
 
-    def get_samples(self, count):
-        data = []
-        if count == 0:
+    @staticmethod
+    def subsample(data, max_history):
+        if max_history is None or len(data) <= max_history:
             return data
-        for name in self.attribute_names:
-            if name in self.constants:
-                data.append(count*[self.constants[name]])
-            data.append(self.kde_estimates[name].resample(count).tolist()[0])
-        return map(self.make_sample, zip(*data))
+        return data[np.sort(np.random.choice(len(data), max_history, replace = False))]
+
+    @staticmethod
+    def factorize(covariance):
+        try:
+            return np.linalg.cholesky(covariance)
+        except np.linalg.LinAlgError:
+            # Degenerate data, e.g. exactly collinear attributes
+            values, vectors = np.linalg.eigh(covariance)
+            return vectors*np.sqrt(np.clip(values, 0, None))
+
+    def get_samples(self, count):
+        if self.joint:
+            rows = self.joint_data[np.random.randint(0, len(self.joint_data), int(count))]
+            return self.make_batch(rows + np.random.standard_normal(rows.shape).dot(self.joint_factor.T), self.names)
+        data = np.empty((count, len(self.names)))
+        for index, name in enumerate(self.names):
+            data[:, index] = self.kde_estimates[name].resample(count)[0]
+        return self.make_batch(data, self.names)
+
+class ReplaySampler(Sampler):
+    """
+    Implementation of the :py:class:`sampling.Sampler` interface that replays archived tool runs of one arm.
+
+    The runs are read from a memory-mapped file, so only the rows that are drawn are loaded and
+    the pages of one dataset are shared by all processes replaying it.
+    
+    ...
+
+    Parameters
+    __________
+    data_path: string
+        The .npy file holding a structured array with one float field per attribute, as written by
+        :py:func:`sampling.write_replay_dataset`. The file is opened read only.
+    """
+    def __init__(self, attribute_names, metric_function, valid_function, constants, data_path, batch_metric_function = None, batch_valid_function = None):
+        super(ReplaySampler, self).__init__(attribute_names, metric_function, valid_function, constants, batch_metric_function, batch_valid_function)
+        self.data_path = data_path
+        self.data = np.load(data_path, mmap_mode = 'r')
+        self.logger = logging.getLogger('Replay Sampler ' + str(id(self)))
+
+    def get_samples(self, count):
+        # Sorted indices keep the reads in file order
+        rows = self.data[np.sort(np.random.randint(0, len(self.data), int(count)))]
+        names = [name for name in self.attribute_names if name not in self.constants]
+        data = np.empty((int(count), len(names)))
+        for index, name in enumerate(names):
+            data[:, index] = rows[name]
+        return self.make_batch(data, names)
+
+    def __getstate__(self):
+        # Reopen the mapping on unpickling rather than copying the dataset
+        state = self.__dict__.copy()
+        del state['data']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.load(self.data_path, mmap_mode = 'r')
+
+def write_replay_dataset(path, attribute_data):
+    """
+    Writes the archived runs of one arm in the format read by :py:class:`sampling.ReplaySampler`.
+    
+    ...
+
+    Parameters
+    __________
+    path: string
+        The .npy file to write.
+    attribute_data: dict
+        Dict containing the mapping from attribute name -> list of data, one entry per run.
+    """
+    names = sorted(attribute_data.keys())
+    data = np.empty((len(attribute_data[names[0]]),), dtype = [(str(name), float) for name in names])
+    for name in names:
+        data[name] = attribute_data[name]
+    np.save(path, data)
+
+class SampleBufferReader(object):
+    """
+    Incrementally parses a comma separated sample buffer that a tool appends rows to.
+
+    Every call to read parses the complete lines written since the last call into one 2d array.
+    
+    ...
+
+    Parameters
+    __________
+    path: string
+        The sample buffer to read. It need not exist yet.
+    attribute_names: list
+        The attribute names expected in the header.
+    logger: logging.Logger
+        The logger to warn about header mismatches on.
+    """
+    def __init__(self, path, attribute_names, logger):
+        self.path = path
+        self.attribute_names = list(attribute_names)
+        self.logger = logger
+        self.file = None
+        self.remainder = ''
+        self.columns = None
+
+    def read(self, final = False):
+        """
+        Parses the rows written since the last call.
+        
+        ...
+
+        Parameters
+        __________
+        final: bool
+            Whether the tool has finished, in which case a last line without a newline is parsed too.
+        """
+        empty = np.empty((0, len(self.attribute_names) if self.columns is None else self.columns))
+        if self.file is None:
+            if not os.path.exists(self.path):
+                return empty
+            # io files do not keep the end-of-file state of stdio, so reads pick up appended rows
+            self.file = io.open(self.path, 'rb')
+        lines = (self.remainder + self.file.read()).split('\n')
+        self.remainder = '' if final else lines.pop()
+        if self.columns is None:
+            if not lines:
+                return empty
+            attributes = lines.pop(0).rstrip().split(',')
+            if attributes != self.attribute_names:
+                self.logger.warning('Attribute name mismatch encountered in buffer: trying to ignore')
+            self.columns = len(attributes)
+            empty = np.empty((0, self.columns))
+        lines = [line for line in lines if line.strip()]
+        if not lines:
+            return empty
+        # Every row is checked on its own, as two malformed rows could otherwise make up a full count of values
+        for line in lines:
+            if line.count(',') != self.columns - 1:
+                raise ValueError('Malformed row in sample buffer ' + self.path + ', expected ' + str(self.columns) + ' columns: ' + line.rstrip())
+        values = np.fromstring(','.join(lines), sep = ',')
+        if len(values) != len(lines)*self.columns:
+            raise ValueError('Non-numeric value in sample buffer ' + self.path)
+        return values.reshape(len(lines), self.columns)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+class ResultCache(object):
+    """
+    An on-disk cache of tool outputs, one file per parameter row.
+
+    Entries are keyed by a hash of the script path, the constants and the parameter row as written
+    to the parameter buffer. When the cache grows past max_bytes the least recently used entries are
+    removed. The cache counts hits and misses, and the tool time that the hits saved.
+
+    The sizes and recency of the entries are kept in memory, read from the directory once when the
+    cache is created, so storing and evicting an entry does not scan the directory. Entries written
+    by other processes are added to the index when they are first hit.
+    
+    ...
+
+    Parameters
+    __________
+    directory: string
+        The directory to store the entries in. It can be shared between campaigns.
+    max_bytes: int
+        The size the cache is trimmed to after every tool run. The cache is unbounded if None.
+    """
+    def __init__(self, directory, max_bytes = None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.load_index()
+        self.reset_stats()
+
+    def load_index(self):
+        """Reads the size and modification time of every entry, oldest first, into the LRU index."""
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npy'):
+                try:
+                    stat = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, name[:-len('.npy')], stat.st_size))
+        self.index = OrderedDict((key, size) for mtime, key, size in sorted(entries))
+        self.total_bytes = sum(self.index.values())
+
+    def reset_stats(self):
+        """Resets the hit counters."""
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def key(self, script_path, constants, row):
+        """
+        Returns the key of one parameter row.
+        
+        ...
+
+        Parameters
+        __________
+        script_path: string
+            The tool script the row is run with.
+        constants: dict
+            The constants of the sampler.
+        row: 1d array
+            The parameter row. It is rounded the way it is written to the parameter buffer.
+        """
+        digest = hashlib.sha1()
+        digest.update(os.path.abspath(script_path))
+        digest.update(json.dumps(sorted(constants.items())))
+        digest.update(','.join('%1.5f' % x for x in row))
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npy')
+
+    def touch(self, key, size):
+        """Records key, of size bytes, as the most recently used entry. Must be called with the lock held."""
+        self.total_bytes += size - self.index.pop(key, 0)
+        self.index[key] = size
+
+    def get(self, key):
+        """Returns the output row stored under key, or None if it is not cached."""
+        try:
+            entry = np.load(self.path(key))
+            os.utime(self.path(key), None)
+            size = self.index.get(key) or os.path.getsize(self.path(key))
+        except (IOError, OSError, ValueError):
+            with self.lock:
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+            self.saved_seconds += entry[0]
+            self.touch(key, size)
+        return entry[1:].tolist()
+
+    def put(self, key, values, seconds):
+        """
+        Stores an output row.
+        
+        ...
+
+        Parameters
+        __________
+        key: string
+            The key of the parameter row the output belongs to.
+        values: list
+            The output row.
+        seconds: float
+            The tool time it took to produce the row.
+        """
+        temp_path = self.path(key) + '.' + str(uuid.uuid4()) + '.tmp'
+        with open(temp_path, 'wb') as f:
+            np.save(f, np.concatenate([[seconds], values]))
+            size = f.tell()
+        os.rename(temp_path, self.path(key))
+        with self.lock:
+            self.touch(key, size)
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in max_bytes."""
+        if self.max_bytes is None:
+            return
+        with self.lock:
+            removed = []
+            while self.index and self.total_bytes > self.max_bytes:
+                key, size = self.index.popitem(last = False)
+                self.total_bytes -= size
+                removed.append(key)
+        for key in removed:
+            try:
+                os.remove(self.path(key))
+            except OSError:
+                pass
+
+    def snapshot(self):
+        """Returns the current counters, to report on a later stretch of work with report."""
+        with self.lock:
+            return (self.hits, self.misses, self.saved_seconds)
+
+    def report(self, since = None):
+        """
+        Returns the hits, misses, hit rate and license-hours saved since a snapshot, or since the
+        last reset_stats if none is given.
+        """
+        hits, misses, saved_seconds = self.snapshot()
+        if since is not None:
+            hits, misses, saved_seconds = hits - since[0], misses - since[1], saved_seconds - since[2]
+        lookups = hits + misses
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': float(hits)/lookups if lookups else 0.0,
+                'saved_hours': saved_seconds/3600}
 
 class ToolSampler(Sampler):
     """ 
@@ -178,16 +746,33 @@ class ToolSampler(Sampler):
         The path to the run script that comes packaged with the tool license. For more details see [3]_.
     params: list
         The mean parameters to supply to the ::py::class::`utils.NoiseModel`. Denoising is performed around these values
+    cache: ResultCache
+        Optional cache of earlier tool outputs. Parameter rows found in it are not run again.
+    poll_interval: float
+        The number of seconds between reads of the sample buffer while the tool runs.
 
     ...
 
+    get_samples runs the tool to completion and reads the sample buffer once. When streaming is asked for,
+    see :py:class:`sampling.AsyncSamplerSet`, the buffer is read while the tool runs, so the tool should append
+    output rows to it after writing the header. Rows are parsed in bulk into arrays, and iter_samples yields
+    them as partial batches.
+
+    When a work directory is given to get_samples, the buffers are placed inside it under the
+    same file names and the script is run from it, so concurrent jobs do not share files. The
+    paths are also exported to the script as MAB_WORK_DIR, MAB_PARAM_BUFFER and MAB_SAMPLE_BUFFER.
+
     References
     __________
     .. [2] Add the reference here.
     .. [3] Add another reference here.
     """
-    def __init__(self, attribute_names, metric_function, valid_function, noise_model, constants, param_buffer, sample_buffer, script_path, params):
-        super(ToolSampler, self).__init__(attribute_names, metric_function, valid_function, constants)
+    needs_work_dir = True
+
+    def __init__(self, attribute_names, metric_function, valid_function, noise_model, constants, param_buffer, sample_buffer, script_path, params, batch_metric_function = None, batch_valid_function = None, cache = None, poll_interval = 0.1):
+        super(ToolSampler, self).__init__(attribute_names, metric_function, valid_function, constants, batch_metric_function, batch_valid_function)
+        self.cache = cache
+        self.poll_interval = poll_interval
         self.params = params
         self.noise_model = noise_model
         self.param_buffer = param_buffer
@@ -195,19 +780,148 @@ class ToolSampler(Sampler):
         self.logger = logging.getLogger('Tool Sampler ' + str(id(self)))
         self.script_path = script_path
 
-    def get_samples(self, count):
+    def start_script(self, work_dir = None, param_buffer = None, sample_buffer = None):
+        """
+        Starts the tool script, optionally from inside a scratch directory, without waiting for it.
+        
+        ...
+
+        Parameters
+        __________
+        work_dir: string
+            The directory to run the script from. The current directory is used if None.
+        param_buffer: string
+            The parameter buffer exported to the script. Defaults to param_buffer.
+        sample_buffer: string
+            The sample buffer exported to the script. Defaults to sample_buffer.
+        """
+        env = dict(os.environ, MAB_PARAM_BUFFER = param_buffer or self.param_buffer, MAB_SAMPLE_BUFFER = sample_buffer or self.sample_buffer)
+        if work_dir is None:
+            return subprocess.Popen('source ' + self.script_path, shell = True, executable = '/bin/bash', env = env)
+        env['MAB_WORK_DIR'] = work_dir
+        return subprocess.Popen('source ' + os.path.abspath(self.script_path), shell = True, executable = '/bin/bash', cwd = work_dir, env = env)
+
+    def run_script(self, work_dir = None, param_buffer = None, sample_buffer = None):
+        """Runs the tool script and waits for it, see :py:func:`sampling.ToolSampler.start_script`."""
+        return self.start_script(work_dir, param_buffer, sample_buffer).wait()
+
+    def prepare_buffers(self, parameter_values, work_dir = None):
+        """
+        Writes the parameter rows to the parameter buffer, removes the output of an earlier run, and
+        returns the paths of the two buffers, placed inside work_dir if one is given.
+        """
+        param_buffer, sample_buffer = self.param_buffer, self.sample_buffer
+        if work_dir is not None:
+            param_buffer = os.path.join(os.path.abspath(work_dir), os.path.basename(self.param_buffer))
+            sample_buffer = os.path.join(os.path.abspath(work_dir), os.path.basename(self.sample_buffer))
+        with open(param_buffer,"w+") as f:
+            np.savetxt(f, parameter_values, delimiter = ',', fmt = '%1.5f')
+        # Remove the output of an earlier run so that it is not read as this run's
+        if os.path.exists(sample_buffer):
+            os.remove(sample_buffer)
+        return param_buffer, sample_buffer
+
+    def stream_tool(self, parameter_values, work_dir = None):
+        """
+        Runs the tool on a set of parameter rows and yields 2d arrays of the output rows as the tool
+        appends them to the sample buffer. The tool must append to the buffer rather than replace it.
+        
+        ...
+
+        Parameters
+        __________
+        parameter_values: 2d array
+            The parameter rows to write to the parameter buffer.
+        work_dir: string
+            The scratch directory to place the buffers in and run the script from, if any.
+        """
+        param_buffer, sample_buffer = self.prepare_buffers(parameter_values, work_dir)
+        process = self.start_script(work_dir, param_buffer, sample_buffer)
+        reader = SampleBufferReader(sample_buffer, self.attribute_names, self.logger)
+        try:
+            finished = False
+            while not finished:
+                finished = process.poll() is not None
+                rows = reader.read(final = finished)
+                if len(rows):
+                    yield rows
+                if not finished:
+                    time.sleep(self.poll_interval)
+        finally:
+            reader.close()
+        if reader.columns is None:
+            raise IOError('Tool did not write the sample buffer ' + sample_buffer)
+
+    def run_tool(self, parameter_values, work_dir = None):
+        """
+        Runs the tool on a set of parameter rows, waits for it, and returns the 2d array of output rows
+        it wrote. The sample buffer is read once, after the tool exits.
+        
+        ...
+
+        Parameters
+        __________
+        parameter_values: 2d array
+            The parameter rows to write to the parameter buffer.
+        work_dir: string
+            The scratch directory to place the buffers in and run the script from, if any.
+        """
+        param_buffer, sample_buffer = self.prepare_buffers(parameter_values, work_dir)
+        self.run_script(work_dir, param_buffer, sample_buffer)
+        reader = SampleBufferReader(sample_buffer, self.attribute_names, self.logger)
+        try:
+            rows = reader.read(final = True)
+        finally:
+            reader.close()
+        if reader.columns is None:
+            raise IOError('Tool did not write the sample buffer ' + sample_buffer)
+        return rows
+
+    def iter_samples(self, count, work_dir = None, stream = False):
+        """
+        Draws count samples, yielding them in batches. Cached rows are yielded first. With stream set,
+        the tool's rows are yielded as it appends them, see :py:func:`sampling.ToolSampler.stream_tool`;
+        otherwise they are read in one piece once it exits.
+        
+        ...
+
+        Parameters
+        __________
+        count: int
+            The number of samples to draw.
+        work_dir: string
+            The scratch directory to run the tool in, if any.
+        stream: bool
+            Whether to read the sample buffer while the tool runs.
+        """
         if count == 0:
-            return []
+            return
+        run = self.stream_tool if stream else lambda values, work_dir: [self.run_tool(values, work_dir)]
         parameter_values = self.noise_model.add_noise(self.params, count)
-        with open(self.param_buffer,"w+") as f:
-            np.savetxt(f, parameter_values, delimiter = ',', fmt = '%1.5f')
-        subprocess.call('source ' + self.script_path, shell = True)
-        values = []
-        with open(self.sample_buffer,"r") as f:
-            header = f.readline()
-            attributes = header.rstrip().split(",")
-            if attributes != list(self.attribute_names):
-                self.logger.warning('Attribute name mismatch encountered in buffer: trying to ignore')
-            for line in f:
-                values.append(map(float, line.split(',')))
-        return map(self.make_sample,values)
+        if self.cache is None:
+            for rows in run(parameter_values, work_dir):
+                yield self.make_batch(rows)
+            return
+        keys = [self.cache.key(self.script_path, self.constants, row) for row in parameter_values]
+        values = [self.cache.get(key) for key in keys]
+        missing = [i for i, v in enumerate(values) if v is None]
+        if len(missing) < count:
+            yield self.make_batch([v for v in values if v is not None])
+        if not missing:
+            return
+        start, outputs = time.time(), []
+        for rows in run(parameter_values[missing], work_dir):
+            outputs.append(rows)
+            yield self.make_batch(rows)
+        outputs = np.concatenate(outputs) if outputs else []
+        if len(outputs) != len(missing):
+            self.logger.warning('Tool returned ' + str(len(outputs)) + ' rows for ' + str(len(missing)) + ' parameter rows: not caching')
+            return
+        seconds = (time.time() - start)/len(missing)
+        for i, output in zip(missing, outputs):
+            self.cache.put(keys[i], output, seconds)
+        self.cache.evict()
+
+    def get_samples(self, count, work_dir = None):
+        pieces = list(self.iter_samples(count, work_dir))
+        return SampleBatch.concatenate(pieces) if pieces else self.make_batch([])
@@ -0,0 +1,174 @@
+#                             MAB-VLSI 
+#
+#                           Copyright 2018 
+#   Regents of the University of California 
+#                         All Rights Reserved
+#
+#                         
+#  MAB-VLSI was developed by Shriram Kumar and Tushar Shah ai at
+#  University of California, San Diego.
+#
+#  If your use of this software contributes to a published paper, we
+#  request that you cite our paper that appears on our website 
+#  http://vlsicad.ucsd.edu/MAB/MAB_v7.pdf
+#
+#  Permission to use, copy, and modify this software and its documentation is
+#  granted only under the following terms and conditions.  Both the
+#  above copyright notice and this permission notice must appear in all copies
+#  of the software, derivative works or modified versions, and any portions
+#  thereof, and both notices must appear in supporting documentation.
+#
+#  This software may be distributed (but not offered for sale or transferred
+#  for compensation) to third parties, provided such third parties agree to
+#  abide by the terms and conditions of this notice.
+#
+#  This software is distributed in the hope that it will be useful to the
+#  community, but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
+
+
+import threading
+
+class LicenseScheduler(object):
+    """
+    Shares one pool of tool licenses between several concurrent MAB campaigns.
+
+    Every campaign, typically one :py:class:`algorithms.ThompsonSampling` instance per design
+    block, obtains a :py:class:`scheduling.Campaign` from the scheduler and uses it as the work
+    directory pool of its :py:class:`sampling.AsyncSamplerSet`. At most len(work_dir_pool) tool
+    jobs run at once across all campaigns. Whenever a slot frees up it is granted to a waiting
+    campaign by weighted fair share (stride scheduling): every grant advances the campaign's pass
+    by 1/priority, and the waiting campaign with the lowest pass is served next, so slots are
+    handed out in proportion to the priorities.
+
+    ...
+
+    Parameters
+    __________
+    work_dir_pool: sampling.WorkDirPool
+        The pool of scratch directories. Its size is the global concurrency limit.
+    min_priority: float
+        The smallest priority a campaign is given, so that a campaign whose posterior reports no
+        expected improvement is still served when licenses are idle.
+    """
+    def __init__(self, work_dir_pool, min_priority = 1e-6):
+        self.work_dir_pool = work_dir_pool
+        self.min_priority = min_priority
+        self.available = len(work_dir_pool)
+        self.campaigns = []
+        self.virtual_time = 0.0
+        self.condition = threading.Condition()
+
+    def campaign(self, priority = 1.0):
+        """
+        Registers a new campaign with the scheduler.
+        
+        ...
+
+        Parameters
+        __________
+        priority: float
+            The initial share of licenses of the campaign, relative to the other campaigns.
+        """
+        with self.condition:
+            campaign = Campaign(self, max(priority, self.min_priority))
+            self.campaigns.append(campaign)
+        return campaign
+
+    def remove(self, campaign):
+        """Unregisters a campaign once it has no jobs running."""
+        with self.condition:
+            self.campaigns.remove(campaign)
+            self.condition.notify_all()
+
+    def next_campaign(self):
+        """Returns the waiting campaign that the next free slot is granted to, or None."""
+        waiting = [c for c in self.campaigns if c.waiting]
+        return min(waiting, key = lambda c: c.pass_value) if waiting else None
+
+    def acquire(self, campaign):
+        """Block until the scheduler grants campaign a slot and return its scratch directory."""
+        with self.condition:
+            if campaign.waiting == 0 and campaign.running == 0:
+                # A campaign returning from idle does not get credit for the time it was idle
+                campaign.pass_value = max(campaign.pass_value, self.virtual_time)
+            campaign.waiting += 1
+            while self.available == 0 or self.next_campaign() is not campaign:
+                self.condition.wait()
+            campaign.waiting -= 1
+            campaign.running += 1
+            campaign.granted += 1
+            self.virtual_time = campaign.pass_value
+            campaign.pass_value += 1.0/campaign.priority
+            self.available -= 1
+            self.condition.notify_all()
+        return self.work_dir_pool.acquire()
+
+    def release(self, campaign, directory):
+        """Return a scratch directory obtained from acquire to the pool."""
+        self.work_dir_pool.release(directory)
+        with self.condition:
+            campaign.running -= 1
+            self.available += 1
+            self.condition.notify_all()
+
+    def set_priority(self, campaign, priority):
+        with self.condition:
+            campaign.priority = max(priority, self.min_priority)
+            self.condition.notify_all()
+
+    def __len__(self):
+        return len(self.work_dir_pool)
+
+class Campaign(object):
+    """
+    A campaign's handle on a :py:class:`scheduling.LicenseScheduler`, obtained from
+    :py:func:`scheduling.LicenseScheduler.campaign`.
+
+    It has the interface of :py:class:`sampling.WorkDirPool`, so it is passed to
+    :py:class:`sampling.AsyncSamplerSet` in place of the pool.
+
+    ...
+
+    Attributes
+    __________
+    priority: float
+        The share of licenses of the campaign, relative to the other campaigns.
+    running: int
+        The number of jobs of the campaign currently holding a slot.
+    waiting: int
+        The number of jobs of the campaign waiting for a slot.
+    granted: int
+        The number of slots granted to the campaign so far.
+    """
+    def __init__(self, scheduler, priority):
+        self.scheduler = scheduler
+        self.priority = priority
+        self.running = 0
+        self.waiting = 0
+        self.granted = 0
+        self.pass_value = 0.0
+
+    def acquire(self):
+        return self.scheduler.acquire(self)
+
+    def release(self, directory):
+        self.scheduler.release(self, directory)
+
+    def set_priority(self, priority):
+        """
+        Changes the share of licenses of the campaign. :py:func:`algorithms.ThompsonSampling.solve`
+        sets it every round to the expected improvement of the campaign's posterior.
+        """
+        self.scheduler.set_priority(self, priority)
+
+    def close(self):
+        """Unregisters the campaign from the scheduler."""
+        self.scheduler.remove(self)
+
+    def cleanup(self):
+        """The scratch directories belong to the scheduler's pool, so nothing is removed."""
+        pass
+
+    def __len__(self):
+        return len(self.scheduler)
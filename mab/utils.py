@@ -29,6 +29,10 @@
 import logging
 import uuid
 import numpy as np
+import threading
+import time
+import json
+from collections import defaultdict
 
 class Sample:
 	def __init__(self, attributes, metric, valid):
@@ -73,15 +77,466 @@ class Sample:
 	#	d['logger'] = None
 	#	return d
 
+logger = logging.getLogger('Sample')
+
+class SampleBatch(object):
+	"""
+	A column oriented batch of samples drawn from one sampler.
+
+	Each attribute is held in one array, and the constants, metric and validity functions are
+	stored once for the whole batch. Indexing or iterating the batch gives lightweight
+	:py:class:`utils.SampleView` rows that behave like :py:class:`utils.Sample`.
+
+	...
+
+	Attributes
+	__________
+	names: list
+		The names of the attributes that have a column, in order.
+	columns: dict
+		The mapping from attribute name -> 1d array of values.
+	constants: dict
+		The set of constants that are part of every sample.
+	batch_metric: function
+		Optional function that takes the dict of attribute columns (see column_data) and returns
+		the array of metric values of all rows at once.
+	batch_valid: function
+		Optional function that takes the dict of attribute columns and returns the boolean
+		array of validity of all rows at once.
+
+	Metric values and validity are evaluated once per batch and cached, whether the batch or
+	the row functions are used.
+	"""
+	def __init__(self, names, columns, constants, metric, valid, length, batch_metric = None, batch_valid = None):
+		self.names = names
+		self.columns = columns
+		self.constants = constants
+		self.metric = metric
+		self.valid = valid
+		self.length = length
+		self.batch_metric = batch_metric
+		self.batch_valid = batch_valid
+		self._metrics = None
+		self._valid = None
+
+	def attributes(self, index):
+		"""Builds the attribute dict of one row, as :py:class:`utils.Sample` holds it."""
+		attributes = dict((name, self.columns[name][index]) for name in self.names)
+		attributes.update(self.constants)
+		return attributes
+
+	def column_data(self):
+		"""Returns the dict of attribute columns with the constants included as scalars."""
+		data = dict(self.columns)
+		data.update(self.constants)
+		return data
+
+	def metrics(self):
+		"""Returns the array of metric values of all rows."""
+		if self._metrics is None:
+			try:
+				if self.batch_metric is not None:
+					metrics = np.broadcast_to(self.batch_metric(self.column_data()), (self.length,))
+				else:
+					metrics = [self.metric(self.attributes(i)) for i in range(self.length)]
+			except Exception as err:
+				logger.error('Metric evaluation failed with exception: ' + str(err))
+				raise Exception('Metric evaluation failed', err)
+			self._metrics = np.array(metrics, dtype = float)
+		return self._metrics
+
+	def valid_mask(self):
+		"""Returns the boolean array of validity of all rows."""
+		if self._valid is None:
+			try:
+				if self.batch_valid is not None:
+					valid = np.broadcast_to(self.batch_valid(self.column_data()), (self.length,))
+				else:
+					valid = [self.valid(self.attributes(i)) for i in range(self.length)]
+			except Exception as err:
+				logger.error('Sample validity check failed with exception: ' + str(err))
+				raise Exception('Sample validity check failed', err)
+			self._valid = np.array(valid, dtype = bool)
+		return self._valid
+
+	@classmethod
+	def concatenate(cls, batches):
+		"""Joins batches drawn from the same sampler into one batch."""
+		first = batches[0]
+		columns = dict((name, np.concatenate([b.columns[name] for b in batches])) for name in first.names)
+		return cls(first.names, columns, first.constants, first.metric, first.valid, sum(len(b) for b in batches),
+		           first.batch_metric, first.batch_valid)
+
+	def __len__(self):
+		return self.length
+
+	def __getitem__(self, index):
+		if index < 0:
+			index += self.length
+		if not 0 <= index < self.length:
+			raise IndexError('Sample batch index out of range')
+		return SampleView(self, index)
+
+	def __iter__(self):
+		return (SampleView(self, i) for i in range(self.length))
+
+class SampleView(object):
+	"""A single row of a :py:class:`utils.SampleBatch` with the interface of :py:class:`utils.Sample`."""
+	__slots__ = ('batch', 'index')
+
+	def __init__(self, batch, index):
+		self.batch = batch
+		self.index = index
+
+	@property
+	def attributes(self):
+		return self.batch.attributes(self.index)
+
+	def get_metric(self):
+		return self.batch.metrics()[self.index]
+
+	def is_valid(self):
+		return self.batch.valid_mask()[self.index]
+
+def concatenate_samples(pieces):
+	"""Joins several lists of samples or :py:class:`utils.SampleBatch` es from the same sampler."""
+	if len(pieces) == 1:
+		return pieces[0]
+	if pieces and all(isinstance(piece, SampleBatch) for piece in pieces):
+		return SampleBatch.concatenate(pieces)
+	return [sample for piece in pieces for sample in piece]
+
+def metric_values(samples):
+	"""Returns the metrics of a list of samples or a :py:class:`utils.SampleBatch` as an array."""
+	if isinstance(samples, SampleBatch):
+		return samples.metrics()
+	return np.array([x.get_metric() for x in samples], dtype = float)
+
+def valid_mask(samples):
+	"""Returns the validity of a list of samples or a :py:class:`utils.SampleBatch` as a boolean array."""
+	if isinstance(samples, SampleBatch):
+		return samples.valid_mask()
+	return np.array([x.is_valid() for x in samples], dtype = bool)
+
+class RoundWindow(object):
+	"""
+	A ring buffer of per-round statistics over the last window rounds, used by reward models
+	that forget old observations. The current round is included in the window.
+
+	...
+
+	Parameters
+	__________
+	window: int
+		The number of rounds kept.
+	fields: int
+		The number of statistics kept per round.
+	shape: tuple
+		The shape of every statistic, typically (arms,).
+	"""
+	def __init__(self, window, fields, shape):
+		self.data = np.zeros((window, fields) + tuple(shape))
+		self.position = 0
+
+	def current(self):
+		"""Returns the fields x shape statistics of the current round, which updates are added to."""
+		return self.data[self.position]
+
+	def advance(self):
+		"""Starts a new round in place of the oldest one and returns the statistics of the dropped round."""
+		self.position = (self.position + 1) % len(self.data)
+		dropped = self.data[self.position].copy()
+		self.data[self.position] = 0
+		return dropped
+
+	def compact(self, keep):
+		"""Keeps only the statistics of the arms at the indices keep, along the last axis."""
+		self.data = self.data[..., keep]
+
+def make_rng(seed = None):
+	"""
+	Returns a random number stream for one object: a numpy.random.Generator, or a RandomState on numpy
+	versions without Generator.
+
+	Without a seed the stream is seeded from the global numpy random state, so np.random.seed
+	still makes runs reproducible.
+	"""
+	if seed is None:
+		seed = np.random.randint(2**31 - 1)
+	if hasattr(np.random, 'default_rng'):
+		return np.random.default_rng(seed)
+	return np.random.RandomState(seed)
+
+class NormalPool(object):
+	"""
+	A block of pre-drawn standard normals that is refilled in bulk.
+
+	Requests larger than the block are drawn directly.
+
+	...
+
+	Parameters
+	__________
+	rng: numpy.random.Generator or numpy.random.RandomState
+		The stream to draw from.
+	block_size: int
+		The number of normals drawn on every refill.
+	"""
+	def __init__(self, rng, block_size):
+		self.rng = rng
+		self.block_size = block_size
+		self.block = np.empty((0,))
+		self.position = 0
+		self.lock = threading.Lock()
+
+	def draw(self, shape):
+		"""Returns an array of standard normals of the given shape."""
+		size = int(np.prod(shape))
+		if size > self.block_size:
+			return self.rng.standard_normal(shape)
+		with self.lock:
+			if self.position + size > len(self.block):
+				# The old block is replaced rather than overwritten, so earlier draws stay valid
+				self.block = self.rng.standard_normal(self.block_size)
+				self.position = 0
+			values = self.block[self.position:self.position + size]
+			self.position += size
+		return values.reshape(shape)
+
+class StageTimer(object):
+	"""Context manager that adds the time spent in its block to a stage of a :py:class:`utils.Profiler`."""
+	def __init__(self, profiler, stage):
+		self.profiler = profiler
+		self.stage = stage
+
+	def __enter__(self):
+		self.start = time.time()
+		return self
+
+	def __exit__(self, *args):
+		self.profiler.add_time(self.stage, time.time() - self.start)
+
+class NullTimer(object):
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		pass
+
+class Profiler(object):
+	"""
+	Collects the timings and counters of every solver round into one record per round.
+
+	A record holds the round index, its wall time, the seconds spent in every stage and the counters
+	set during the round. Stages are timed with the time context manager.
+
+	...
+
+	Parameters
+	__________
+	path: string
+		If given, every record is also appended to this file as a JSON line.
+
+	Attributes
+	__________
+	records: list
+		The records of the completed rounds.
+	"""
+	def __init__(self, path = None):
+		self.path = path
+		self.records = []
+		self.current = None
+
+	def start_round(self, index):
+		self.current = {'round': index, 'times': defaultdict(float)}
+		self.round_start = time.time()
+
+	def time(self, stage):
+		"""Returns a context manager that times its block as part of stage."""
+		return StageTimer(self, stage)
+
+	def add_time(self, stage, seconds):
+		self.current['times'][stage] += seconds
+
+	def count(self, name, value):
+		"""Sets a counter of the current round. Arrays are stored as lists."""
+		self.current[name] = value.tolist() if isinstance(value, np.ndarray) else value
+
+	def end_round(self):
+		self.current['wall_time'] = time.time() - self.round_start
+		self.current['times'] = dict(self.current['times'])
+		self.records.append(self.current)
+		if self.path is not None:
+			with open(self.path, 'a') as f:
+				f.write(json.dumps(self.current) + '\n')
+		self.current = None
+
+class NullProfiler(Profiler):
+	"""A :py:class:`utils.Profiler` that records nothing. It is the default, so instrumentation costs a few calls per round."""
+	timer = NullTimer()
+
+	def __init__(self):
+		self.records = []
+
+	def start_round(self, index):
+		pass
+
+	def time(self, stage):
+		return self.timer
+
+	def add_time(self, stage, seconds):
+		pass
+
+	def count(self, name, value):
+		pass
+
+	def end_round(self):
+		pass
+
 class NoiseModel(object):
 	def add_noise(self, x, count):
 		raise NotImplementedError()
 
 class GaussianNoiseModel(NoiseModel):
-	def __init__(self, variance):
+	"""
+	Adds independent normal noise with a fixed variance to every parameter.
+
+	...
+
+	Parameters
+	__________
+	variance: list
+		The noise variance of every parameter.
+	seed: int
+		The seed of the noise stream of the model, see :py:func:`utils.make_rng`.
+	block_size: int
+		If given, normals are drawn from a :py:class:`utils.NormalPool` of this block size.
+	"""
+	def __init__(self, variance, seed = None, block_size = None):
 		self.variance = variance
+		self.scale = np.sqrt(np.asarray(variance, dtype = float))
+		self.rng = make_rng(seed)
+		self.normals = NormalPool(self.rng, block_size) if block_size else None
+
+	def standard_normal(self, shape):
+		return self.rng.standard_normal(shape) if self.normals is None else self.normals.draw(shape)
+
+	def add_noise(self, x, count):
+		if len(x) != len(self.variance):
+			raise Exception('Dimension mismatch: expected x with dim ' + str(len(self.variance)))
+		return np.asarray(x, dtype = float) + self.standard_normal((count, len(self.scale)))*self.scale
+
+
+class BlockDiagonalNoiseModel(GaussianNoiseModel):
+	"""
+	Adds normal noise that is correlated within groups of parameters and independent between them,
+	e.g. a clock uncertainty together with the IO delays derived from it.
+
+	Every block is factorized once, so the cost of noise generation grows with the sum of the
+	squared block sizes rather than the squared dimension.
+
+	...
+
+	Parameters
+	__________
+	blocks: list
+		The list of (indices, covariance) pairs, one per group. Together the indices must cover
+		every parameter exactly once; use a 1x1 covariance for independent parameters.
+	seed: int
+		The seed of the noise stream of the model, see :py:func:`utils.make_rng`.
+	block_size: int
+		If given, normals are drawn from a :py:class:`utils.NormalPool` of this block size.
+	"""
+	def __init__(self, blocks, seed = None, block_size = None):
+		self.blocks = [(np.asarray(indices, dtype = int), np.linalg.cholesky(np.atleast_2d(covariance))) for indices, covariance in blocks]
+		variance = np.zeros((sum(len(indices) for indices, factor in self.blocks),))
+		for indices, factor in self.blocks:
+			variance[indices] = (factor**2).sum(axis = 1)
+		if len(np.unique(np.concatenate([indices for indices, factor in self.blocks]))) != len(variance):
+			raise Exception('Noise blocks must cover every parameter exactly once')
+		super(BlockDiagonalNoiseModel, self).__init__(variance, seed, block_size)
+
+	def add_noise(self, x, count):
+		if len(x) != len(self.variance):
+			raise Exception('Dimension mismatch: expected x with dim ' + str(len(self.variance)))
+		normals = self.standard_normal((count, len(self.variance)))
+		noise = np.empty_like(normals)
+		for indices, factor in self.blocks:
+			noise[:, indices] = normals[:, indices].dot(factor.T)
+		return np.asarray(x, dtype = float) + noise
+
+class LowRankNoiseModel(GaussianNoiseModel):
+	"""
+	Adds normal noise whose covariance is a low rank part plus a diagonal, factor.factor^T + diag(variance),
+	i.e. a few shared sources of variation on top of independent per-parameter noise.
+
+	The cost of noise generation grows with the dimension times the rank.
+
+	...
+
+	Parameters
+	__________
+	factor: 2d array
+		The dim x rank loading of the parameters on the shared sources.
+	variance: list
+		The independent noise variance of every parameter.
+	seed: int
+		The seed of the noise stream of the model, see :py:func:`utils.make_rng`.
+	block_size: int
+		If given, normals are drawn from a :py:class:`utils.NormalPool` of this block size.
+	"""
+	def __init__(self, factor, variance, seed = None, block_size = None):
+		super(LowRankNoiseModel, self).__init__(variance, seed, block_size)
+		self.factor = np.asarray(factor, dtype = float).reshape(len(self.scale), -1)
+
 	def add_noise(self, x, count):
 		if len(x) != len(self.variance):
 			raise Exception('Dimension mismatch: expected x with dim ' + str(len(self.variance)))
-		return np.random.multivariate_normal(x, np.diag(self.variance),count)
+		rank = self.factor.shape[1]
+		normals = self.standard_normal((count, rank + len(self.scale)))
+		return np.asarray(x, dtype = float) + normals[:, :rank].dot(self.factor.T) + normals[:, rank:]*self.scale
+
+class QuasiRandomNoiseModel(GaussianNoiseModel):
+	"""
+	Adds independent normal noise generated from a space filling design instead of pseudo random
+	numbers, so that a small batch of perturbations covers the parameter space evenly.
+
+	...
 
+	Parameters
+	__________
+	variance: list
+		The noise variance of every parameter.
+	method: string
+		'lhs' for Latin hypercube designs, drawn afresh for every batch, or 'sobol' for a scrambled
+		Sobol sequence that continues across batches. Sobol needs scipy.stats.qmc (scipy >= 1.7).
+	seed: int
+		The seed of the noise stream of the model, see :py:func:`utils.make_rng`.
+	"""
+	def __init__(self, variance, method = 'lhs', seed = None):
+		super(QuasiRandomNoiseModel, self).__init__(variance, seed)
+		from scipy.special import ndtri
+		self.ndtri = ndtri
+		self.method = method
+		if method == 'sobol':
+			try:
+				from scipy.stats import qmc
+			except ImportError:
+				raise ImportError('Sobol perturbation requires scipy.stats.qmc (scipy >= 1.7)')
+			self.sobol = qmc.Sobol(len(self.scale), scramble = True, seed = int(self.rng.uniform(0, 2**31 - 1)))
+		elif method != 'lhs':
+			raise Exception('Unknown quasi random method: ' + str(method))
+
+	def uniform_points(self, count):
+		"""Returns count points of the design in the unit hypercube."""
+		if self.method == 'sobol':
+			return self.sobol.random(count)
+		# One point in each of the count strata of every dimension, the strata paired at random
+		strata = np.argsort(self.rng.uniform(size = (count, len(self.scale))), axis = 0)
+		return (strata + self.rng.uniform(size = strata.shape))/count
+
+	def add_noise(self, x, count):
+		if len(x) != len(self.variance):
+			raise Exception('Dimension mismatch: expected x with dim ' + str(len(self.variance)))
+		points = np.clip(self.uniform_points(count), 1e-12, 1 - 1e-12)
+		return np.asarray(x, dtype = float) + self.ndtri(points)*self.scale
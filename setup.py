@@ -36,10 +36,12 @@ setup(name='mab',
       author_email='shriramck@gmail.com',
       packages=['mab'],
       install_requires=[
-      'pytest-cov',
       'numpy',
       'scipy',
       'uuid',
-      'pymc3',
       ],
+      extras_require={
+      'mcmc': ['pymc3'],
+      'test': ['pytest-cov', 'mock'],
+      },
       zip_safe=False)
\ No newline at end of file
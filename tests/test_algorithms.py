@@ -29,9 +29,12 @@
 from context import mab
 from collections import defaultdict
 from mab.algorithms import *
-from mab.sampling import Sampler, SamplerSet
+from mab.sampling import Sampler, SamplerSet, AsyncSamplerSet, WorkDirPool
 from mab.rewards import RewardModel
 import unittest
+import json
+import tempfile
+import os
 
 class DummyRewardModel(RewardModel):
     def __init__(self, size):
@@ -66,13 +69,195 @@ class TestAlgorithms(unittest.TestCase):
         for i, s in enumerate(smp_set.samplers):
             self.assertEqual(len(rm.samples[i]), s.total_count)
 
+    def test_allocation_history(self):
+        rm = DummyRewardModel(3)
+        smp_set = SamplerSet([DummySampler(), DummySampler(), DummySampler()])
+        ts = ThompsonSampling(smp_set, rm)
+        ts.solve(4, 5)
+        self.assertEqual(ts.allocation_history.shape, (4, 3))
+        self.assertTrue(np.all(ts.allocation_history.sum(axis = 1) == 5))
+        self.assertEqual(list(ts.allocation_history.sum(axis = 0)), list(ts.total_count))
+        self.assertEqual(list(ts.total_count), [s.total_count for s in smp_set.samplers])
+
+    def test_profiler(self):
+        from mab.utils import Profiler
+        rm = DummyRewardModel(2)
+        smp_set = SamplerSet([DummySampler(), DummySampler()])
+        ts = ThompsonSampling(smp_set, rm)
+        handle, path = tempfile.mkstemp(suffix = '.jsonl')
+        os.close(handle)
+        try:
+            ts.set_profiler(Profiler(path))
+            ts.solve(3, 4)
+            with open(path) as f:
+                lines = f.readlines()
+        finally:
+            os.remove(path)
+        self.assertEqual(len(ts.profiler.records), 3)
+        self.assertEqual(len(lines), 3)
+        record = json.loads(lines[-1])
+        self.assertEqual(record['round'], 2)
+        self.assertEqual(sum(record['samples_per_arm']), 4)
+        self.assertEqual(record['posterior_draws'], 4)
+        for stage in ['sample_posterior.DummyRewardModel', 'get_samples', 'get_samples.DummySampler', 'update.DummyRewardModel', 'best_sample']:
+            self.assertTrue(0 <= record['times'][stage] <= record['wall_time'])
+
+    def test_checkpoint_resume(self):
+        from mab.rewards import BinomialRewardModel
+        from mab.sampling import GaussianSampler
+        make_samplers = lambda: SamplerSet([GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 0, {'b': 1}, [m], [1]) for m in [0, 1]])
+        ts = ThompsonSampling(make_samplers(), BinomialRewardModel(2))
+        ts.solve(3, 4, 'tests/checkpoint.tmp', 2)
+        # Only the checkpoint of round 2 exists when the driver "crashes" in round 3
+        restored = ThompsonSampling(make_samplers(), BinomialRewardModel(2))
+        restored.load_checkpoint('tests/checkpoint.tmp')
+        self.assertEqual(restored.rounds_completed, 2)
+        self.assertEqual(restored.total_count.sum(), 8)
+        self.assertEqual(restored.reward_models.a.sum() + restored.reward_models.b.sum(), 12)
+        self.assertEqual(restored.best_sample.get_metric(), restored.best_metric_history[-1])
+        restored.resume('tests/checkpoint.tmp', 5, 4)
+        self.assertEqual(restored.rounds_completed, 5)
+        self.assertEqual(restored.allocation_history.shape, (5, 2))
+        self.assertTrue(np.all(restored.allocation_history.sum(axis = 1) == 4))
+        self.assertEqual(list(restored.allocation_history.sum(axis = 0)), list(restored.total_count))
+        self.assertEqual(restored.reward_models.a.sum() + restored.reward_models.b.sum(), 24)
+
+    def test_async_update_samples(self):
+        rm = DummyRewardModel(2)
+        pool = WorkDirPool(3)
+        smp_set = AsyncSamplerSet([DummySampler(), DummySampler()], pool)
+        ts = ThompsonSampling(smp_set, rm)
+        smp = ts.solve_async(11, 3)
+        smp_set.close()
+        pool.cleanup()
+        self.assertEqual(sum(s.total_count for s in smp_set.samplers), 11)
+        self.assertEqual(ts.total_count.sum(), 11)
+        for i, s in enumerate(smp_set.samplers):
+            self.assertEqual(len(rm.samples[i]), s.total_count)
+        self.assertEqual(smp.get_metric(), 1)
+
     def test_best_sample_returned(self):
-        """.. todo:: Test that the best out of a set of samples is returned."""
-        pass
+        rm = DummyRewardModel(2)
+        smp_set = SamplerSet([DummySampler(), DummySampler()])
+        smp_set.samplers[0].load_samples([Sample({'a': m}, lambda x: x['a'], lambda x: True) for m in [1, 5, 3]])
+        smp_set.samplers[1].load_samples([Sample({'a': 2}, lambda x: x['a'], lambda x: True)])
+        ts = ThompsonSampling(smp_set, rm)
+        smp = ts.solve(10, 10)
+        self.assertEqual(smp.get_metric(), 5)
 
     def test_only_valid(self):
-        """.. todo:: Test only valid samples are considered"""
-        pass
+        rm = DummyRewardModel(2)
+        smp_set = SamplerSet([DummySampler(), DummySampler()])
+        smp_set.samplers[0].load_samples([Sample({'a': m}, lambda x: x['a'], lambda x: x['a'] < 4) for m in [1, 5, 3]])
+        smp_set.samplers[1].load_samples([Sample({'a': 9}, lambda x: x['a'], lambda x: False)])
+        ts = ThompsonSampling(smp_set, rm)
+        smp = ts.solve(10, 10)
+        self.assertEqual(smp.get_metric(), 3)
+
+    def test_stopping_rules(self):
+        from mab.rewards import BinomialRewardModel
+        from mab.sampling import GaussianSampler
+        np.random.seed(0)
+        make_samplers = lambda: SamplerSet([GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 0, {}, [m], [0.1]) for m in [-1, 1]])
+        ts = ThompsonSampling(make_samplers(), BinomialRewardModel(2))
+        ts.solve(50, 10, stopping_rules = [ProbabilityOfBest(0.99)])
+        self.assertTrue(ts.rounds_completed < 50)
+        self.assertEqual(ts.allocation_history.shape, (ts.rounds_completed, 2))
+        self.assertTrue(ts.stopping_reason.startswith('Arm 1'))
+        ts = ThompsonSampling(make_samplers(), BinomialRewardModel(2))
+        draws = []
+        sample_posterior = ts.reward_models.sample_posterior
+        ts.reward_models.sample_posterior = lambda count = 1: draws.append(count) or sample_posterior(count)
+        ts.solve(50, 10, stopping_rules = [ExpectedImprovement(1e-3)])
+        self.assertTrue(ts.rounds_completed < 50)
+        self.assertTrue(ts.stopping_reason.startswith('Expected improvement'))
+        # Rounds smaller than the rule's minimum are topped up, larger ones are reused as they are
+        self.assertEqual(draws, [10, 90]*ts.rounds_completed)
+        del draws[:]
+        ts.solve(1, 10, stopping_rules = [ExpectedImprovement(-1, draws = 10)])
+        self.assertEqual(draws, [10])
+        rm = DummyRewardModel(2)
+        ts = ThompsonSampling(SamplerSet([DummySampler(), DummySampler()]), rm)
+        ts.solve(20, 2, stopping_rules = [NoImprovement(3)])
+        self.assertEqual(ts.rounds_completed, 4)
+        self.assertEqual(len(ts.best_metric_history), 4)
+        ts.solve(2, 2)
+        self.assertEqual(ts.stopping_reason, None)
+        self.assertEqual(ts.rounds_completed, 6)
+
+    def test_stopping_rules_small_rounds(self):
+        from mab.rewards import BinomialRewardModel
+        from mab.sampling import GaussianSampler
+        # A single draw per round is always certain of its arm, so the rules must not stop on it alone
+        for rule in [ProbabilityOfBest(0.99), ExpectedImprovement(1e-3)]:
+            np.random.seed(0)
+            samplers = SamplerSet([GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 0, {}, [m], [0.1]) for m in [-1, 1]])
+            ts = ThompsonSampling(samplers, BinomialRewardModel(2))
+            ts.solve(100, 1, stopping_rules = [rule])
+            self.assertTrue(3 < ts.rounds_completed < 100)
+        self.assertEqual(ProbabilityOfBest(0.99).min_draws, 200)
+        self.assertRaises(ValueError, ProbabilityOfBest, 1)
+
+    def test_successive_elimination(self):
+        from mab.rewards import BinomialRewardModel
+        from mab.sampling import GaussianSampler
+        np.random.seed(0)
+        make_samplers = lambda: SamplerSet([GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 0, {}, [m], [1]) for m in [-3, 0.5, -3, 3]])
+        ts = ThompsonSampling(make_samplers(), BinomialRewardModel(4))
+        ts.solve(6, 20, 'tests/checkpoint.tmp', elimination = SuccessiveElimination(0.01))
+        self.assertTrue(3 in ts.active_arms)
+        self.assertTrue(len(ts.active_arms) < 4)
+        self.assertEqual(ts.reward_models.size, len(ts.active_arms))
+        self.assertEqual(len(ts.sampler_set), len(ts.active_arms))
+        self.assertEqual(list(ts.allocation_history.sum(axis = 0)), list(ts.total_count))
+        self.assertTrue(np.all(ts.allocation_history.sum(axis = 1) == 20))
+        restored = ThompsonSampling(make_samplers(), BinomialRewardModel(4))
+        restored.load_checkpoint('tests/checkpoint.tmp')
+        self.assertEqual(list(restored.active_arms), list(ts.active_arms))
+        self.assertEqual(list(restored.reward_models.a), list(ts.reward_models.a))
+        self.assertEqual(len(restored.sampler_set), len(ts.active_arms))
+        restored.solve(2, 20)
+        self.assertEqual(restored.total_count.sum(), 160)
+
+    def test_elimination_small_rounds(self):
+        from mab.rewards import BinomialRewardModel
+        from mab.sampling import GaussianSampler
+        # A round of one or two draws cannot resolve the quantiles, so nothing is eliminated on it alone
+        for seed in range(20):
+            np.random.seed(seed)
+            samplers = SamplerSet([GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 0, {}, [m], [1]) for m in [-3, -1, 0, 1, 3]])
+            ts = ThompsonSampling(samplers, BinomialRewardModel(5))
+            ts.solve(1, seed % 2 + 1, elimination = SuccessiveElimination())
+            self.assertTrue(4 in ts.active_arms)
+
+    def test_elimination_with_stopping_rules(self):
+        from mab.rewards import BinomialRewardModel
+        from mab.sampling import GaussianSampler
+        make_samplers = lambda: SamplerSet([GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 0, {}, [m], [1]) for m in [-3, 0.5, -3, 3]])
+        for rule in [ProbabilityOfBest(0.999), ProbabilityOfBest(0.999, draws = 200), ExpectedImprovement(1e-6, draws = 100)]:
+            np.random.seed(0)
+            ts = ThompsonSampling(make_samplers(), BinomialRewardModel(4))
+            ts.solve(10, 20, stopping_rules = [rule], elimination = SuccessiveElimination(0.01))
+            self.assertTrue(len(ts.active_arms) < 4)
+            self.assertTrue(3 in ts.active_arms)
+
+    def test_elimination_on_campaign_view(self):
+        from mab.rewards import StackedBinomialRewardModel
+        from mab.sampling import GaussianSampler
+        from mab.utils import Profiler
+        np.random.seed(0)
+        stack = StackedBinomialRewardModel(2, 4, seed = 0)
+        samplers = SamplerSet([GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 0, {}, [m], [1]) for m in [-3, 0.5, -3, 3]])
+        ts = ThompsonSampling(samplers, stack.view(1))
+        ts.set_profiler(Profiler())
+        ts.solve(6, 20, elimination = SuccessiveElimination(0.01, every = 2))
+        self.assertTrue(len(ts.active_arms) < 4)
+        self.assertEqual(list(ts.reward_models.arms), list(ts.active_arms))
+        self.assertEqual(stack.a.shape, (2, 4))
+        self.assertEqual(list(stack.a[0]), [1]*4)
+        self.assertEqual(stack.a[1].sum() + stack.b[1].sum(), 8 + 120)
+        for record in ts.profiler.records:
+            self.assertEqual(len(record['samples_per_arm']), 4)
 
     def test_algorithm_properties(self):
         """.. todo:: Testing the algorithm. Weak tests: the better arm is sampled more by margin - XX%, """
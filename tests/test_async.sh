@@ -0,0 +1,4 @@
+NUM=$(cat $MAB_PARAM_BUFFER | wc -l)
+sleep 0.2
+echo a,b > $MAB_SAMPLE_BUFFER
+for ((i=0; i<NUM; i++)); do echo $i,$NUM; done >> $MAB_SAMPLE_BUFFER
@@ -0,0 +1,58 @@
+#                             MAB-VLSI 
+#
+#                           Copyright 2018 
+#   Regents of the University of California 
+#                         All Rights Reserved
+#
+#                         
+#  MAB-VLSI was developed by Shriram Kumar and Tushar Shah ai at
+#  University of California, San Diego.
+#
+#  If your use of this software contributes to a published paper, we
+#  request that you cite our paper that appears on our website 
+#  http://vlsicad.ucsd.edu/MAB/MAB_v7.pdf
+#
+#  Permission to use, copy, and modify this software and its documentation is
+#  granted only under the following terms and conditions.  Both the
+#  above copyright notice and this permission notice must appear in all copies
+#  of the software, derivative works or modified versions, and any portions
+#  thereof, and both notices must appear in supporting documentation.
+#
+#  This software may be distributed (but not offered for sale or transferred
+#  for compensation) to third parties, provided such third parties agree to
+#  abide by the terms and conditions of this notice.
+#
+#  This software is distributed in the hope that it will be useful to the
+#  community, but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
+
+
+from context import mab
+from mab.evaluation import *
+from mab.algorithms import ThompsonSampling
+from mab.rewards import BinomialRewardModel
+from mab.sampling import GaussianSampler, SamplerSet
+import unittest
+
+def make_solver():
+    samplers = [GaussianSampler(['a'], lambda x: x['a'], lambda x: x['a'] > 1, {}, [mean], [1]) for mean in [0, 1, 2]]
+    return ThompsonSampling(SamplerSet(samplers), BinomialRewardModel(3))
+
+class TestEvaluation(unittest.TestCase):
+    def test_run_trials_shapes(self):
+        results = run_trials(make_solver, 3, 4, 5, optimal_metric = 10, processes = 1)
+        self.assertEqual(results['best_metric'].shape, (3, 4))
+        self.assertEqual(results['allocations'].shape, (3, 4, 3))
+        self.assertTrue(np.all(results['allocations'].sum(axis = 2) == 5))
+        self.assertTrue(np.allclose(results['regret'], 10 - results['best_metric']))
+        self.assertTrue(np.all(np.diff(results['best_metric'], axis = 1) >= 0))
+
+    def test_run_trials_reproducible(self):
+        serial = run_trials(make_solver, 4, 3, 5, processes = 1, seed = 7)
+        parallel = run_trials(make_solver, 4, 3, 5, processes = 2, seed = 7)
+        self.assertTrue(np.array_equal(serial['best_metric'], parallel['best_metric']))
+        self.assertTrue(np.array_equal(serial['allocations'], parallel['allocations']))
+        self.assertEqual(list(serial['seeds']), [7, 8, 9, 10])
+
+if __name__ == '__main__':
+    unittest.main()
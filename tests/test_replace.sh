@@ -0,0 +1,4 @@
+NUM=$(cat $MAB_PARAM_BUFFER | wc -l)
+echo a,b > $MAB_SAMPLE_BUFFER.part
+for ((i=0; i<NUM; i++)); do echo $i,$NUM; done >> $MAB_SAMPLE_BUFFER.part
+mv $MAB_SAMPLE_BUFFER.part $MAB_SAMPLE_BUFFER
@@ -28,6 +28,8 @@
 
 from context import mab
 from mab.rewards import *
+from mab.utils import SampleBatch
+import threading
 import unittest
 import uuid
 
@@ -51,12 +53,96 @@ class TestRewards(unittest.TestCase):
         self.assertEqual(m.a[0], 1)
         self.assertEqual(m.b[0], 1)
 
+    def test_binomial_update_batch(self):
+        m = BinomialRewardModel(2)
+        batch = SampleBatch(['a'], {'a': np.array([1., 0., 1.])}, {}, lambda x: x['a'], lambda x: x['a'] > 0, 3)
+        m.update(batch, 0)
+        self.assertEqual(m.a[0], 3)
+        self.assertEqual(m.b[0], 2)
+
     def test_binomial_sample_posterior(self):
         m = BinomialRewardModel(2)
         x, y = m.sample_posterior(10).shape
         self.assertEqual(x, 10)
         self.assertEqual(y, 2)
 
+    def test_binomial_beta_draws(self):
+        m = BinomialRewardModel(2, seed = 0)
+        m.a[:] = [3, 1]
+        m.b[:] = [1, 3]
+        s = m.sample_posterior(20000)
+        self.assertTrue(np.all((s > 0) & (s < 1)))
+        self.assertAlmostEqual(s[:, 0].mean(), 0.75, delta = 0.01)
+        self.assertAlmostEqual(s[:, 1].mean(), 0.25, delta = 0.01)
+        self.assertTrue(np.array_equal(BinomialRewardModel(2, seed = 1).sample_posterior(5), BinomialRewardModel(2, seed = 1).sample_posterior(5)))
+
+    def test_gamma_beta_draws(self):
+        # The Gamma ratio path runs on numpy.random.Generator streams, which older numpy lacks
+        class GammaStream(object):
+            def __init__(self, seed):
+                self.state = np.random.RandomState(seed)
+            def standard_gamma(self, shape, size, out):
+                out[...] = self.state.standard_gamma(shape, size)
+                return out
+        m = BinomialRewardModel(2)
+        m.rng = GammaStream(0)
+        m.a[:] = [3, 1]
+        m.b[:] = [1, 3]
+        s = m.sample_posterior(20000)
+        self.assertTrue(np.all((s > 0) & (s < 1)))
+        self.assertAlmostEqual(s[:, 0].mean(), 0.75, delta = 0.01)
+        self.assertAlmostEqual(s[:, 1].mean(), 0.25, delta = 0.01)
+        self.assertEqual(m.gamma_buffer.size, 40000)
+        stack = StackedBinomialRewardModel(2, 2)
+        stack.rng = GammaStream(1)
+        stack.a[1] = [3, 1]
+        stack.b[1] = [1, 3]
+        views = [stack.view(c) for c in range(2)]
+        results = [None]*2
+        def sample(c):
+            results[c] = views[c].sample_posterior(20000)
+        threads = [threading.Thread(target = sample, args = (c,)) for c in range(2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Views never write into the stack's scratch buffer
+        self.assertTrue(stack.gamma_buffer is None)
+        self.assertAlmostEqual(results[0][:, 0].mean(), 0.5, delta = 0.01)
+        self.assertAlmostEqual(results[1][:, 0].mean(), 0.75, delta = 0.01)
+        self.assertAlmostEqual(results[1][:, 1].mean(), 0.25, delta = 0.01)
+
+    def test_sample_allocation(self):
+        m = BinomialRewardModel(3, seed = 0)
+        m.a[:] = [50, 1, 1]
+        m.allocation_block = 64
+        counts = m.sample_allocation(1000)
+        self.assertEqual(counts.sum(), 1000)
+        self.assertTrue(counts[0] > 950)
+        self.assertEqual(m.draw_buffer.size, 64*3)
+        c = ConstrainedRewardModel(3, [1]*3)
+        self.assertEqual(c.sample_allocation(10).sum(), 10)
+
+    def test_stacked_binomial(self):
+        m = StackedBinomialRewardModel(3, 2, seed = 0)
+        m.update_counts([0, 0, 2], [1, 1, 0], [4, 5, 0], [0, 1, 9])
+        self.assertEqual(m.a[0, 1], 10)
+        self.assertEqual(m.b[0, 1], 2)
+        self.assertEqual(m.b[2, 0], 10)
+        self.assertEqual(m.sample_posterior(4).shape, (4, 3, 2))
+        m.allocation_block = 4
+        allocations = m.sample_allocations([100, 0, 50])
+        self.assertEqual(list(allocations.sum(axis = 1)), [100, 0, 50])
+        self.assertTrue(allocations[0, 1] > 80)
+        self.assertTrue(allocations[2, 1] > 40)
+        view = m.view(1)
+        view.update([DummySample(True, 0)]*3, 0)
+        self.assertEqual(m.a[1, 0], 4)
+        self.assertEqual(view.sample_posterior(5).shape, (5, 2))
+        self.assertEqual(view.sample_allocation(7).sum(), 7)
+        view.set_state({'a': [1, 1], 'b': [2, 2]})
+        self.assertEqual(list(m.b[1]), [2, 2])
+
     def test_reward_model(self):
         m = RewardModel(2)
         self.assertRaises(NotImplementedError, m.update, [], 1)
@@ -68,6 +154,16 @@ class TestRewards(unittest.TestCase):
         self.assertEqual(s.shape, (10, 5))
         self.assertTrue(np.all(s[:,1:] < s[:, :-1]))
     
+    def test_constrained_batched_distribution(self):
+        # With uniform priors the ordered pair is distributed as the order statistics of two uniforms.
+        np.random.seed(0)
+        m = ConstrainedRewardModel(2, [1, 2], max_iter = 50)
+        s = m.sample_posterior(4000)
+        self.assertTrue(np.all(s[:, 0] > s[:, 1]/2))
+        self.assertAlmostEqual(s[:, 0].mean(), 2./3, delta = 0.03)
+        self.assertAlmostEqual(s[:, 1].mean(), 2./3, delta = 0.03)
+        self.assertEqual(len(m.get_truncated_sample()), 2)
+
     def test_gaussian_sample_posterior_raw(self):
         m = GaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5)
         v = m.sample_posterior(10)
@@ -85,11 +181,144 @@ class TestRewards(unittest.TestCase):
     def test_gaussian_update(self):
         samples = [DummySample(True, 1), DummySample(False, 0.9), DummySample(True, 1.1)]
         m = GaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5)
+        m.update(samples[:1], 1)
+        m.update(samples[1:], 1)
+        self.assertEqual(list(m.counts), [0, 3])
+        self.assertAlmostEqual(m.means[1], 1)
+        self.assertAlmostEqual(m.squares[1], 0.02)
+        self.assertEqual(m.current_maxima, 1.1)
+
+    def test_gibbs_gaussian_sample_posterior_raw(self):
+        m = GibbsGaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5)
+        v = m.sample_posterior(10)
+        self.assertTrue(np.all(v == 1))
+        self.assertEqual(v.shape, (10, 2))
+
+    def test_gibbs_gaussian_sample_posterior(self):
+        np.random.seed(0)
+        samples = [DummySample(True, 3 + 0.01*i) for i in range(50)]
+        m = GibbsGaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5, sample_burn = 50, sample_thin = 1)
         m.update(samples, 1)
-        sample_ids = [sample.id for sample in samples]
-        self.assertEqual(m.data.keys(), [1])
-        for sample in m.data[1]:
-            self.assertTrue(sample.id in sample_ids)
+        v = m.sample_posterior(200)
+        self.assertEqual(v.shape, (200, 2))
+        self.assertAlmostEqual(m.mu[1], 3.2, delta = 0.2)
+        # The noise posterior is dominated by the 50 samples, whose sum of squared deviations is about 1.04
+        self.assertAlmostEqual(1/np.sqrt(m.tau[1]), np.sqrt(0.52/25.4), delta = 0.05)
+        self.assertTrue(np.all((v >= 0) & (v <= 1)))
+
+    def test_precision_prior(self):
+        # A Gamma(a, b) prior on sigma and the converted prior on 1/sigma**2 agree in the log-moments
+        np.random.seed(0)
+        shape, rate = precision_prior(1, 5)
+        log_tau = np.log(1/np.random.gamma(1, 1/5., 200000)**2)
+        converted = np.log(np.random.gamma(shape, 1/rate, 200000))
+        self.assertAlmostEqual(log_tau.mean(), converted.mean(), delta = 0.05)
+        self.assertAlmostEqual(log_tau.var(), converted.var(), delta = 0.15)
+
+    def test_gaussian_engines_agree(self):
+        np.random.seed(0)
+        data = [np.random.normal(1.0, 0.3, 30), np.random.normal(0.6, 0.3, 30)]
+        means = []
+        for engine in [GaussianProcessModel, GibbsGaussianProcessModel]:
+            m = engine(np.eye(2), 1, 5, [0, 0], 1, sample_burn = 100, sample_thin = 2, sample_tune = 500)
+            for index, metrics in enumerate(data):
+                m.update([DummySample(True, x) for x in metrics], index)
+            means.append(m.sample_posterior(300).mean(axis = 0))
+        self.assertAlmostEqual(means[0][0], means[1][0], delta = 0.02)
+        self.assertAlmostEqual(means[0][1], means[1][1], delta = 0.005)
+
+    def test_gibbs_gaussian_state(self):
+        m = GibbsGaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5)
+        m.update([DummySample(True, 1), DummySample(True, 2)], 0)
+        restored = GibbsGaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5)
+        restored.set_state(m.get_state())
+        self.assertEqual(list(restored.counts), [2, 0])
+        self.assertEqual(list(restored.means), [1.5, 0])
+        self.assertEqual(restored.current_maxima, 2)
+
+    def test_binomial_discount_and_window(self):
+        m = BinomialRewardModel(2, discount = 0.5)
+        m.update([DummySample(True, 0)]*4 + [DummySample(False, 0)]*2, 0)
+        m.advance()
+        self.assertEqual(list(m.a), [3, 1])
+        self.assertEqual(list(m.b), [2, 1])
+        m = BinomialRewardModel(2, window = 2)
+        for valid in [True, False, False]:
+            m.advance()
+            m.update([DummySample(valid, 0)]*3, 1)
+        self.assertEqual(list(m.a), [1, 1])
+        self.assertEqual(list(m.b), [1, 7])
+        restored = BinomialRewardModel(2, window = 2)
+        restored.set_state(m.get_state())
+        restored.advance()
+        self.assertEqual(list(restored.b), [1, 4])
+        self.assertRaises(Exception, BinomialRewardModel, 2, discount = 0.5, window = 2)
+
+    def test_constrained_discount_and_window(self):
+        m = ConstrainedRewardModel(3, [1, 2, 3], window = 2)
+        for valid in [True, False, False]:
+            m.advance()
+            m.update([DummySample(valid, 0)]*3, 2)
+        self.assertEqual(list(m.a), [1, 1, 1])
+        self.assertEqual(list(m.b), [1, 1, 7])
+        self.assertEqual(m.sample_posterior(4).shape, (4, 3))
+        m = ConstrainedRewardModel(3, [1, 2, 3], discount = 0.5)
+        m.update([DummySample(True, 0)]*4, 0)
+        m.advance()
+        self.assertEqual(list(m.a), [3, 1, 1])
+        first, second = ConstrainedRewardModel(3, [1, 2, 3], seed = 1), ConstrainedRewardModel(3, [1, 2, 3], seed = 1)
+        self.assertTrue(np.array_equal(first.sample_posterior(5), second.sample_posterior(5)))
+
+    def test_gibbs_gaussian_window(self):
+        m = GibbsGaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5, window = 2)
+        rounds = [[1., 2.], [3.], [4., 6., 8.]]
+        for metrics in rounds:
+            m.advance()
+            m.update([DummySample(True, x) for x in metrics], 0)
+        recent = np.array(rounds[1] + rounds[2])
+        self.assertEqual(m.counts[0], 4)
+        self.assertAlmostEqual(m.means[0], recent.mean())
+        self.assertAlmostEqual(m.squares[0], ((recent - recent.mean())**2).sum())
+        self.assertEqual(m.current_maxima, 8)
+        m.advance()
+        self.assertAlmostEqual(m.means[0], 6)
+        self.assertEqual(list(m.counts), [3, 0])
+        # After a drift the old maximum leaves the window with its round
+        m.update([DummySample(True, 2.), DummySample(False, 9.)], 1)
+        m.advance()
+        self.assertEqual(m.current_maxima, 2)
+        m.advance()
+        self.assertEqual(m.current_maxima, -np.inf)
+        d = GibbsGaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5, discount = 0.5)
+        d.update([DummySample(True, 1), DummySample(True, 3)], 1)
+        d.advance()
+        self.assertEqual(list(d.counts), [0, 1])
+        self.assertEqual(d.means[1], 2)
+        self.assertEqual(d.squares[1], 1)
+        self.assertEqual(d.current_maxima, 2.5)
+        restored = GibbsGaussianProcessModel(np.diag([1, 1]), 1, 5, [0, 0], 5, window = 2)
+        restored.set_state(m.get_state())
+        self.assertTrue(np.array_equal(restored.history.data, m.history.data))
+
+    def test_stacked_views_need_a_stationary_stack(self):
+        self.assertRaises(Exception, StackedBinomialRewardModel(2, 3, window = 2).view, 0)
+        self.assertRaises(Exception, StackedBinomialRewardModel(2, 3, discount = 0.9).view, 0)
+
+    def test_compact(self):
+        m = ConstrainedRewardModel(4, [1, 2, 3, 4])
+        m.a[:] = [1, 2, 3, 4]
+        m.compact(np.array([1, 3]))
+        self.assertEqual(list(m.a), [2, 4])
+        self.assertEqual(list(m.reward_values), [2, 4])
+        self.assertEqual(m.sample_posterior(3).shape, (3, 2))
+        g = GibbsGaussianProcessModel(np.diag([1., 2., 3.]), 1, 5, [0, 1, 2], 5, window = 2)
+        g.update([DummySample(True, 1), DummySample(True, 3)], 2)
+        g.compact(np.array([0, 2]))
+        self.assertEqual(list(g.counts), [0, 2])
+        self.assertEqual(list(np.diag(g.kernel)), [5, 15])
+        self.assertEqual(g.history.data.shape, (2, 5, 2))
+        self.assertEqual(g.sample_posterior(4).shape, (4, 2))
+        self.assertRaises(NotImplementedError, RewardModel(2).compact, [0])
 
 if __name__ == '__main__':
     unittest.main()
@@ -28,12 +28,15 @@
 
 from context import mab
 from mab.sampling import *
-from mab.utils import GaussianNoiseModel
+from mab.utils import GaussianNoiseModel, BlockDiagonalNoiseModel, LowRankNoiseModel, QuasiRandomNoiseModel, SampleBatch
 import unittest
 import random
 from mock import MagicMock
 import pdb
 import numpy as np
+import os
+import shutil
+import time
 
 class TestSamplers(unittest.TestCase):
 	def test_base_sampler_make(self):
@@ -56,6 +59,29 @@ class TestSamplers(unittest.TestCase):
 		sampler = Sampler(random_attributes, random_metric, lambda x: True, random_constants)
 		self.assertRaises(NotImplementedError, sampler.get_samples, 1)
 
+	def test_base_sampler_make_batch(self):
+		sampler = Sampler(['a', 'b'], lambda x: x['a'] + x['constant1'], lambda x: x['b'] > 0, {'constant1': 1})
+		batch = sampler.make_batch([[1, -1], [2, 1], [3, 1]])
+		self.assertEqual(len(batch), 3)
+		self.assertEqual(sorted(batch.columns.keys()), ['a', 'b'])
+		self.assertEqual(batch[1].attributes, {'a': 2, 'b': 1, 'constant1': 1})
+		self.assertEqual(list(batch.metrics()), [2, 3, 4])
+		self.assertEqual(list(batch.valid_mask()), [False, True, True])
+		self.assertEqual([s.get_metric() for s in batch], [2, 3, 4])
+		self.assertEqual(len(sampler.make_batch([])), 0)
+
+	def test_batch_functions(self):
+		calls = []
+		def metric(x):
+			calls.append(1)
+			return x['a'] + x['constant1']
+		sampler = GaussianSampler(['a'], None, None, {'constant1': 1}, [0], [1], metric, lambda x: x['a'] > 0)
+		batch = sampler.get_samples(20)
+		self.assertTrue(np.allclose(batch.metrics(), batch.columns['a'] + 1))
+		self.assertTrue(np.all(batch.valid_mask() == (batch.columns['a'] > 0)))
+		self.assertEqual(batch[3].get_metric(), batch.columns['a'][3] + 1)
+		self.assertEqual(len(calls), 1)
+
 	def test_sample_handler(self):
 		samplers = [Sampler(['name'], lambda x: 0, lambda x: True, {'constant1': 1}), Sampler(['name'], lambda x: 1, lambda x: True, {'constant1': 1})]
 		samplers[0].get_samples = lambda x: [samplers[0].make_sample([0])]*x
@@ -74,6 +100,44 @@ class TestSamplers(unittest.TestCase):
 			self.assertEqual(sample.attributes.keys(), ['a', 'b', 'constant1'])
 			self.assertEqual(sample.attributes['constant1'], 1)
 
+	def test_gaussian_seeded_pool(self):
+		pooled = GaussianSampler(['a', 'b'], lambda x: x['a'], lambda x: True, {}, [1, -1], [2, 0.5], seed = 3, block_size = 64)
+		direct = GaussianSampler(['a', 'b'], lambda x: x['a'], lambda x: True, {}, [1, -1], [2, 0.5], seed = 3)
+		self.assertTrue(np.allclose(pooled.get_samples(5).columns['a'], direct.get_samples(5).columns['a']))
+		samples = np.concatenate([pooled.get_samples(7).columns['b'] for i in range(2000)])
+		self.assertAlmostEqual(samples.mean(), -1, delta = 0.02)
+		self.assertAlmostEqual(samples.std(), 0.5, delta = 0.02)
+
+	def test_gaussian_noise_model(self):
+		noise_model = GaussianNoiseModel([4, 0], seed = 1, block_size = 16)
+		noise = noise_model.add_noise([1, 2], 5000)
+		self.assertEqual(noise.shape, (5000, 2))
+		self.assertTrue(np.all(noise[:, 1] == 2))
+		self.assertAlmostEqual(noise[:, 0].std(), 2, delta = 0.1)
+		self.assertRaises(Exception, noise_model.add_noise, [1], 2)
+
+	def test_block_diagonal_noise_model(self):
+		covariance = [[1, 0.9], [0.9, 1]]
+		noise_model = BlockDiagonalNoiseModel([([0, 2], covariance), ([1], [[4]])], seed = 0)
+		noise = noise_model.add_noise([0, 0, 0], 20000)
+		self.assertTrue(np.allclose(np.cov(noise.T), [[1, 0, 0.9], [0, 4, 0], [0.9, 0, 1]], atol = 0.1))
+		self.assertRaises(Exception, BlockDiagonalNoiseModel, [([0, 1], covariance), ([1], [[1]])])
+
+	def test_low_rank_noise_model(self):
+		factor = np.array([[1], [2], [0]])
+		noise_model = LowRankNoiseModel(factor, [0.5, 0.5, 1], seed = 0)
+		noise = noise_model.add_noise([1, 1, 1], 20000)
+		self.assertTrue(np.allclose(np.cov(noise.T), factor.dot(factor.T) + np.diag([0.5, 0.5, 1]), atol = 0.15))
+
+	def test_quasi_random_noise_model(self):
+		noise_model = QuasiRandomNoiseModel([1, 4], seed = 0)
+		points = noise_model.uniform_points(50)
+		for column in points.T:
+			self.assertEqual(sorted(np.floor(column*50).astype(int)), range(50))
+		noise = noise_model.add_noise([0, 10], 1000)
+		self.assertAlmostEqual(noise[:, 1].mean(), 10, delta = 0.05)
+		self.assertAlmostEqual(noise[:, 1].std(), 2, delta = 0.1)
+
 	def test_kde_get_samples(self):
 		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2]}
 		sampler = KdeSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {'constant1': 1}, data)
@@ -83,6 +147,19 @@ class TestSamplers(unittest.TestCase):
 			self.assertEqual(sample.attributes.keys(), ['a', 'b', 'constant1'])
 			self.assertEqual(sample.attributes['constant1'], 1)
 
+	def test_kde_joint_get_samples(self):
+		np.random.seed(0)
+		a = np.random.normal(0, 1, 500)
+		data = {'a': a, 'b': 2*a + np.random.normal(0, 0.1, 500)}
+		sampler = KdeSampler(['a', 'b'], lambda x: x['a'], lambda x: True, {'constant1': 1}, data, joint = True, max_history = 200)
+		self.assertEqual(sampler.joint_data.shape, (200, 2))
+		samples = sampler.get_samples(1000)
+		self.assertEqual(len(samples), 1000)
+		self.assertEqual(samples[0].attributes['constant1'], 1)
+		self.assertTrue(np.corrcoef(samples.columns['a'], samples.columns['b'])[0, 1] > 0.9)
+		independent = KdeSampler(['a', 'b'], lambda x: x['a'], lambda x: True, {'constant1': 1}, data).get_samples(1000)
+		self.assertTrue(abs(np.corrcoef(independent.columns['a'], independent.columns['b'])[0, 1]) < 0.2)
+
 	def test_kde_constant_with_data(self):
 		data = {'a' : [1, 2, 3], 'b': [1, 1.1, 1.2], 'constant1': [1, 2]}
 		sampler = KdeSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, {'constant1': 1}, data)
@@ -90,6 +167,17 @@ class TestSamplers(unittest.TestCase):
 		for sample in samples:
 			self.assertEqual(sample.attributes['constant1'], 1)
 
+	def test_replay_get_samples(self):
+		write_replay_dataset('tests/replay.tmp.npy', {'a': [1, 2, 3], 'b': [10, 20, 30]})
+		sampler = ReplaySampler(['a', 'b'], lambda x: x['a'], lambda x: True, {'constant1': 1}, 'tests/replay.tmp.npy')
+		samples = sampler.get_samples(20)
+		os.remove('tests/replay.tmp.npy')
+		self.assertEqual(len(samples), 20)
+		self.assertTrue(np.all(samples.columns['b'] == 10*samples.columns['a']))
+		self.assertTrue(set(samples.columns['a']) <= set([1, 2, 3]))
+		self.assertEqual(samples[0].attributes['constant1'], 1)
+		self.assertEqual(len(sampler.get_samples(0)), 0)
+
 	def test_tool_get_samples(self):
 		noise_model = GaussianNoiseModel([0.01, 0.1])
 		scipt_path = "tests/test.sh"
@@ -99,5 +187,132 @@ class TestSamplers(unittest.TestCase):
 		for index, sample in enumerate(samples):
 			self.assertEqual(sample.attributes.values(), [index, index, 1])
 
+	def test_async_tool_get_samples(self):
+		# Samplers sharing buffer names must not see each other's files when run concurrently.
+		noise_model = GaussianNoiseModel([0.01, 0.1])
+		samplers = [ToolSampler(['a', 'b'], lambda x: sum(x.values()), lambda x: True, noise_model, {'constant1': 1}, 'params.tmp', 'samples.tmp', 'tests/test_async.sh', [1, 2]) for i in range(3)]
+		pool = WorkDirPool(2)
+		sampler_set = AsyncSamplerSet(samplers, pool)
+		samples = sampler_set.get_samples([3, 0, 5])
+		sampler_set.close()
+		pool.cleanup()
+		self.assertEqual(map(len, samples), [3, 0, 5])
+		for sample in samples[2]:
+			self.assertEqual(sample.attributes['b'], 5)
+
+	def test_async_submit_wait(self):
+		samplers = [GaussianSampler(['a'], lambda x: x['a'], lambda x: True, {}, [0], [1]) for i in range(2)]
+		pool = WorkDirPool(2)
+		sampler_set = AsyncSamplerSet(samplers, pool)
+		sampler_set.submit(1, 4)
+		index, samples = sampler_set.wait()
+		sampler_set.close()
+		pool.cleanup()
+		self.assertEqual(index, 1)
+		self.assertEqual(len(samples), 4)
+		self.assertEqual(sampler_set.pending, 0)
+
+	def test_tool_stream_samples(self):
+		noise_model = GaussianNoiseModel([0.01, 0.1])
+		sampler = ToolSampler(['a', 'b'], lambda x: x['a'], lambda x: True, noise_model, {'constant1': 1}, 'tests/params.tmp', 'tests/samples.tmp', 'tests/test_stream.sh', [1, 2], poll_interval = 0.05)
+		pieces = list(sampler.iter_samples(4, stream = True))
+		self.assertTrue(len(pieces) > 1)
+		self.assertEqual(sum(map(len, pieces)), 4)
+		self.assertEqual(list(SampleBatch.concatenate(pieces).columns['a']), [0, 1, 2, 3])
+		pool = WorkDirPool(1)
+		sampler_set = AsyncSamplerSet([sampler], pool, stream = True)
+		sampler_set.submit(0, 3)
+		sizes = []
+		while True:
+			index, samples, done = sampler_set.wait_partial()
+			if done:
+				break
+			sizes.append(len(samples))
+		sampler_set.close()
+		pool.cleanup()
+		self.assertTrue(len(sizes) > 1)
+		self.assertEqual(sum(sizes), 3)
+
+	def test_sample_buffer_reader(self):
+		with open('tests/buffer.tmp', 'w') as f:
+			f.write('a,b\n1,2\n3,')
+		reader = SampleBufferReader('tests/buffer.tmp', ['a', 'b'], None)
+		first = reader.read()
+		with open('tests/buffer.tmp', 'a') as f:
+			f.write('4\n5,6')
+		second = reader.read(final = True)
+		reader.close()
+		os.remove('tests/buffer.tmp')
+		self.assertEqual(first.tolist(), [[1, 2]])
+		self.assertEqual(second.tolist(), [[3, 4], [5, 6]])
+		# A short row followed by a long one has the right number of values, but must not be reshaped
+		with open('tests/buffer.tmp', 'w') as f:
+			f.write('a,b\n1,2\n3\n4,5,6\n')
+		reader = SampleBufferReader('tests/buffer.tmp', ['a', 'b'], None)
+		self.assertRaises(ValueError, reader.read, True)
+		reader.close()
+		os.remove('tests/buffer.tmp')
+
+	def test_tool_get_samples_blocking(self):
+		# Without streaming the buffer is read once the tool exits, so it may be moved into place
+		noise_model = GaussianNoiseModel([0.01, 0.1])
+		sampler = ToolSampler(['a', 'b'], lambda x: x['a'], lambda x: True, noise_model, {}, 'tests/params.tmp', 'tests/samples.tmp', 'tests/test_replace.sh', [1, 2], poll_interval = 10)
+		start = time.time()
+		samples = sampler.get_samples(3)
+		self.assertTrue(time.time() - start < 5)
+		self.assertEqual(list(samples.columns['a']), [0, 1, 2])
+		self.assertEqual(list(samples.columns['b']), [3, 3, 3])
+
+	def test_tool_cache(self):
+		cache = ResultCache('tests/cache.tmp')
+		noise_model = GaussianNoiseModel([0, 0])
+		sampler = ToolSampler(['a', 'b'], lambda x: x['a'], lambda x: True, noise_model, {'constant1': 1}, 'tests/params.tmp', 'tests/samples.tmp', 'tests/test_async.sh', [1, 2], cache = cache)
+		sampler.start_script = MagicMock(side_effect = sampler.start_script)
+		first = sampler.get_samples(3)
+		second = sampler.get_samples(2)
+		report = cache.report()
+		shutil.rmtree('tests/cache.tmp')
+		self.assertEqual(sampler.start_script.call_count, 1)
+		self.assertEqual(list(first.columns['b']), [3, 3, 3])
+		self.assertEqual(list(second.columns['b']), [3, 3])
+		self.assertEqual((report['hits'], report['misses']), (2, 3))
+		self.assertTrue(report['saved_hours'] > 0)
+
+	def test_solve_cache_report(self):
+		from mab.algorithms import ThompsonSampling
+		from mab.rewards import BinomialRewardModel
+		cache = ResultCache('tests/cache.tmp')
+		sampler = ToolSampler(['a', 'b'], lambda x: x['a'], lambda x: True, GaussianNoiseModel([0, 0]), {}, 'tests/params.tmp', 'tests/samples.tmp', 'tests/test_async.sh', [1, 2], cache = cache)
+		solver = ThompsonSampling(SamplerSet([sampler]), BinomialRewardModel(1))
+		solver.solve(1, 2)
+		first = solver.cache_report
+		solver.solve(2, 2)
+		second = solver.cache_report
+		shutil.rmtree('tests/cache.tmp')
+		self.assertEqual((first['hits'], first['misses']), (0, 2))
+		self.assertEqual((second['hits'], second['misses']), (4, 0))
+		self.assertTrue(second['saved_hours'] > 0)
+
+	def test_cache_eviction(self):
+		cache = ResultCache('tests/cache.tmp', max_bytes = 0)
+		cache.put(cache.key('run.sh', {}, [1, 2]), [1.0], 1.0)
+		cache.evict()
+		hit = cache.get(cache.key('run.sh', {}, [1, 2]))
+		self.assertEqual(hit, None)
+		self.assertEqual(cache.total_bytes, 0)
+		# Least recently used entries go first, and an existing directory is indexed once on creation
+		keys = [cache.key('run.sh', {}, [i]) for i in range(3)]
+		for i, key in enumerate(keys):
+			cache.put(key, [1.0], 1.0)
+			os.utime(cache.path(key), (1000 + i, 1000 + i))
+		size = cache.total_bytes/3
+		reopened = ResultCache('tests/cache.tmp', max_bytes = 2*size)
+		self.assertEqual(reopened.total_bytes, 3*size)
+		reopened.get(keys[0])
+		reopened.evict()
+		hits = [reopened.get(key) is not None for key in keys]
+		shutil.rmtree('tests/cache.tmp')
+		self.assertEqual(hits, [True, False, True])
+
 if __name__ == "__main__":
 	unittest.main()
\ No newline at end of file
@@ -0,0 +1,154 @@
+#                             MAB-VLSI 
+#
+#                           Copyright 2018 
+#   Regents of the University of California 
+#                         All Rights Reserved
+#
+#                         
+#  MAB-VLSI was developed by Shriram Kumar and Tushar Shah ai at
+#  University of California, San Diego.
+#
+#  If your use of this software contributes to a published paper, we
+#  request that you cite our paper that appears on our website 
+#  http://vlsicad.ucsd.edu/MAB/MAB_v7.pdf
+#
+#  Permission to use, copy, and modify this software and its documentation is
+#  granted only under the following terms and conditions.  Both the
+#  above copyright notice and this permission notice must appear in all copies
+#  of the software, derivative works or modified versions, and any portions
+#  thereof, and both notices must appear in supporting documentation.
+#
+#  This software may be distributed (but not offered for sale or transferred
+#  for compensation) to third parties, provided such third parties agree to
+#  abide by the terms and conditions of this notice.
+#
+#  This software is distributed in the hope that it will be useful to the
+#  community, but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  
+
+
+from context import mab
+from mab.scheduling import LicenseScheduler
+from mab.sampling import Sampler, AsyncSamplerSet, WorkDirPool
+from mab.algorithms import ThompsonSampling
+from mab.rewards import BinomialRewardModel
+import numpy as np
+import threading
+import time
+import unittest
+
+class CountingSampler(Sampler):
+    needs_work_dir = True
+    def __init__(self, counter):
+        super(CountingSampler, self).__init__(['a'], lambda x: x['a'], lambda x: True, {})
+        self.counter = counter
+    def get_samples(self, count, work_dir = None):
+        self.counter.enter()
+        time.sleep(0.01)
+        self.counter.leave()
+        return self.make_batch(np.ones((count, 1)))
+
+class ConcurrencyCounter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+    def enter(self):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+    def leave(self):
+        with self.lock:
+            self.active -= 1
+
+class TestScheduling(unittest.TestCase):
+    def test_weighted_fair_share(self):
+        pool = WorkDirPool(1)
+        scheduler = LicenseScheduler(pool)
+        high, low, holder = scheduler.campaign(3), scheduler.campaign(1), scheduler.campaign()
+        directory = holder.acquire()
+        order = []
+        def job(campaign, name):
+            d = campaign.acquire()
+            order.append(name)
+            campaign.release(d)
+        threads = [threading.Thread(target = job, args = (c, n)) for c, n in [(high, 'h')]*6 + [(low, 'l')]*6]
+        for t in threads:
+            t.start()
+        while high.waiting + low.waiting < 12:
+            time.sleep(0.01)
+        holder.release(directory)
+        for t in threads:
+            t.join()
+        pool.cleanup()
+        self.assertEqual(order[:8].count('h'), 6)
+        self.assertEqual(len(order), 12)
+
+    def test_shared_limit(self):
+        pool = WorkDirPool(2)
+        scheduler = LicenseScheduler(pool)
+        counter = ConcurrencyCounter()
+        solvers = []
+        for i in range(3):
+            campaign = scheduler.campaign()
+            solver = ThompsonSampling(AsyncSamplerSet([CountingSampler(counter) for k in range(4)], campaign), BinomialRewardModel(4))
+            solver.set_campaign(campaign)
+            solvers.append(solver)
+        threads = [threading.Thread(target = s.solve, args = (3, 8)) for s in solvers]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for s in solvers:
+            s.sampler_set.close()
+        pool.cleanup()
+        self.assertEqual(counter.peak, 2)
+        self.assertEqual(scheduler.available, 2)
+        for s in solvers:
+            self.assertEqual(s.total_count.sum(), 24)
+            self.assertTrue(s.campaign.priority >= scheduler.min_priority)
+
+    def test_async_priority(self):
+        pool = WorkDirPool(2)
+        scheduler = LicenseScheduler(pool)
+        counter = ConcurrencyCounter()
+        campaign = scheduler.campaign()
+        priorities = []
+        set_priority = campaign.set_priority
+        campaign.set_priority = lambda p: priorities.append(p) or set_priority(p)
+        solver = ThompsonSampling(AsyncSamplerSet([CountingSampler(counter) for k in range(3)], campaign), BinomialRewardModel(3))
+        solver.set_campaign(campaign)
+        solver.solve_async(10, 2)
+        solver.sampler_set.close()
+        pool.cleanup()
+        # One refresh for the first launches and one for every refilled slot
+        self.assertEqual(len(priorities), 9)
+        self.assertEqual(campaign.priority, max(priorities[-1], scheduler.min_priority))
+        self.assertNotEqual(campaign.priority, 1.0)
+
+    def test_round_priority(self):
+        pool = WorkDirPool(1)
+        scheduler = LicenseScheduler(pool)
+        counter = ConcurrencyCounter()
+        campaign = scheduler.campaign()
+        priorities = []
+        set_priority = campaign.set_priority
+        campaign.set_priority = lambda p: priorities.append(p) or set_priority(p)
+        solver = ThompsonSampling(AsyncSamplerSet([CountingSampler(counter) for k in range(3)], campaign), BinomialRewardModel(3))
+        solver.set_campaign(campaign)
+        # Rounds of one sample still estimate the priority from priority_draws samples
+        solver.solve(5, 1)
+        solver.sampler_set.close()
+        pool.cleanup()
+        self.assertEqual(len(priorities), 5)
+        self.assertTrue(all(p > 0 for p in priorities))
+        self.assertEqual(solver.total_count.sum(), 5)
+
+    def test_expected_improvement(self):
+        settled = np.tile([[0.9, 0.1]], (50, 1))
+        self.assertAlmostEqual(ThompsonSampling.expected_improvement(settled), 0)
+        draws = np.array([[1.0, 0.0], [0.0, 1.0]])
+        self.assertEqual(ThompsonSampling.expected_improvement(draws), 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
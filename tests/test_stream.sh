@@ -0,0 +1,3 @@
+NUM=$(cat $MAB_PARAM_BUFFER | wc -l)
+echo a,b > $MAB_SAMPLE_BUFFER
+for ((i=0; i<NUM; i++)); do sleep 0.2; echo $i,$NUM >> $MAB_SAMPLE_BUFFER; done